@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of vectorized against reference implementations."""
+
+import os
+import tempfile
+import tracemalloc
+from time import time
+
+import numpy as np
+
+import estimate
+import ingest
+import models
+import utils
+
+
+def random_model_dat(ndim, mdim, density):
+    """random identification matrices of an acyclic model,
+    random direct effects and random covariance matrix of direct effects"""
+
+    idy = np.tril(np.random.rand(ndim, ndim) < density, -1).astype(int)
+    idx = (np.random.rand(ndim, mdim) < density).astype(int)
+    edx, edy = utils.compute_ed(idx, idy)
+    qxdim = np.count_nonzero(idx)
+    qydim = np.count_nonzero(idy)
+    model_dat = {
+        "idx": idx,
+        "idy": idy,
+        "edx": edx,
+        "edy": edy,
+        "ndim": ndim,
+        "mdim": mdim,
+        "qxdim": qxdim,
+        "qydim": qydim,
+        "qdim": qxdim + qydim,
+        "direct_ind": utils.direct_indices(idx, idy),
+        "fym_ind": np.arange(ndim),
+        }
+
+    direct = np.random.normal(scale=0.3, size=model_dat["qdim"])
+    root = np.random.normal(size=(model_dat["qdim"], model_dat["qdim"]))
+    vcm_direct = root @ root.T / model_dat["qdim"]
+
+    return model_dat, direct, vcm_direct
+
+def tvals_loop(eff, std):
+    """reference t-values, element wise loop"""
+
+    tvalues = np.zeros(eff.shape)
+    for ind in np.ndindex(eff.shape):
+        if std[ind] != 0:
+            tvalues[ind] = eff[ind] / std[ind]
+        else:
+            tvalues[ind] = np.nan
+
+    return tvalues
+
+def digital_loop(mat):
+    """reference digital matrix, element wise loop"""
+
+    mat_digital = np.zeros(mat.shape)
+    for ind in np.ndindex(mat.shape):
+        if mat[ind] != 0:
+            mat_digital[ind] = 1
+
+    return mat_digital
+
+def vecmat_loop(mz):
+    """reference matrix of individually vectorized nonzero elements, element wise loop"""
+
+    ndim, mdim = mz.shape
+    vec_mat = np.zeros((ndim * mdim, np.count_nonzero(mz)))
+    k = 0
+    for col in range(mdim):
+        for row in range(ndim):
+            if mz[row, col] != 0:
+                mi = np.zeros((ndim, mdim))
+                mi[row, col] = mz[row, col]
+                vec_mat[:, k] = np.reshape(mi, ndim * mdim, order='F')
+                k += 1
+
+    return vec_mat
+
+def colnorm_loop(eyx):
+    """reference mediation column normalization, column wise loop"""
+
+    x_colsum = np.sum(eyx, axis=0)
+    x_colsum[x_colsum == 0] = np.nan
+    eyx_colnorm = np.full(eyx.shape, np.nan)
+    for j in range(eyx.shape[1]):
+        if not np.isnan(x_colsum[j]):
+            eyx_colnorm[:, j] = eyx[:, j] / x_colsum[j]
+
+    return eyx_colnorm
+
+def timed(func, *args):
+    """result and seconds of function call"""
+
+    start = time()
+    result = func(*args)
+
+    return result, time() - start
+
+def bench_effects_std(ndims=(10, 30, 60, 100, 200), ndim_max_kron=60):
+    """total effects standard deviations, Kronecker against gathered Jacobian,
+    Kronecker products of dimension (ndim * ndim, ndim * ndim) only up to ndim_max_kron"""
+
+    print("\nTotal effects standard deviations, Kronecker (alg) vs. gathered (struct) Jacobian:")
+    for ndim in ndims:
+        model_dat, direct, vcm_direct = random_model_dat(ndim, ndim // 2, min(0.3, 4 / ndim))
+        model_dat["jacobian_backend"] = "struct"
+        (ex_std, ey_std), sec_struct = timed(utils.total_effects_std,
+                                             direct, vcm_direct, model_dat)
+        line = "ndim {:4d}, qdim {:6d}, struct {:10f} s".format(
+            ndim, model_dat["qdim"], sec_struct)
+        if ndim <= ndim_max_kron:
+            model_dat["jacobian_backend"] = "alg"
+            (ex_std_kron, ey_std_kron), sec_kron = timed(utils.total_effects_std,
+                                                         direct, vcm_direct, model_dat)
+            line += ", alg {:10f} s, max abs diff {:e}".format(
+                sec_kron, max(np.max(abs(ex_std - ex_std_kron)),
+                              np.max(abs(ey_std - ey_std_kron))))
+        else:
+            line += ", alg skipped, kron needs {:.1f} GB".format(ndim**4 * 8 / 1e9)
+        print(line)
+
+def bench_sparse(ndims=(100, 300, 600), tau=200):
+    """total effects and algebraic sse gradient, dense against sparse direct effects,
+    for models with few parents per variable"""
+
+    print("\nTotal effects and sse gradient, dense vs. sparse:")
+    for ndim in ndims:
+        model_dat, direct, _ = random_model_dat(ndim, ndim // 10, 3 / ndim)
+        mx, my = utils.directmat_alg(direct, model_dat["idx"], model_dat["idy"])
+        (ex, ey), sec_dense = timed(utils.total_effects, mx, my,
+                                    model_dat["edx"], model_dat["edy"])
+        (ex_sp, ey_sp), sec_sparse = timed(utils.total_effects, mx, my,
+                                           model_dat["edx"], model_dat["edy"], True)
+        print("ndim {:4d}, qdim {:6d}, total effects dense {:10f} s, sparse {:10f} s, "
+              "max abs diff {:e}".format(ndim, model_dat["qdim"], sec_dense, sec_sparse,
+                                        max(np.max(abs(ex - ex_sp)), np.max(abs(ey - ey_sp)))))
+
+        xcdat = np.random.normal(size=(model_dat["mdim"], tau))
+        ycdat = np.random.normal(size=(ndim, tau))
+        model_dat.update({
+            "moments": utils.compute_moments(xcdat, ycdat),
+            "selwei": np.eye(ndim),
+            "alpha": 0.1,
+            })
+        grad, sec_dense = timed(estimate.sse_grad_alg, direct, model_dat)
+        model_dat["sparse"] = True
+        grad_sp, sec_sparse = timed(estimate.sse_grad_alg, direct, model_dat)
+        print("{:23s} sse gradient  dense {:10f} s, sparse {:10f} s, max abs diff {:e}"
+              .format("", sec_dense, sec_sparse, np.max(abs(grad - grad_sp))))
+
+def bench_triangular(ndims=(5, 10, 50, 100, 300), tau=100):
+    """total effects for stacked observations and algebraic sse Hessian,
+    general inverse against forward substitution for strictly lower triangular my"""
+
+    print("\nTotal effects and sse Hessian, inverse vs. triangular:")
+    for ndim in ndims:
+        model_dat, direct, _ = random_model_dat(ndim, ndim // 2, min(0.3, 4 / ndim))
+        mx, my = utils.directmat_alg(direct, model_dat["idx"], model_dat["idy"])
+        mxs = np.broadcast_to(mx, (tau,) + mx.shape)
+        mys = np.broadcast_to(my, (tau,) + my.shape)
+        (ex, ey), sec_inv = timed(utils.total_effects_alg, mxs, mys,
+                                  model_dat["edx"], model_dat["edy"])
+        (ex_tri, ey_tri), sec_tri = timed(utils.total_effects_alg, mxs, mys,
+                                          model_dat["edx"], model_dat["edy"], True)
+        print("ndim {:4d}, tau {:4d}, total effects inverse {:10f} s, triangular {:10f} s, "
+              "max abs diff {:e}".format(ndim, tau, sec_inv, sec_tri,
+                                        max(np.max(abs(ex - ex_tri)), np.max(abs(ey - ey_tri)))))
+
+        model_dat.update({
+            "moments": utils.compute_moments(np.random.normal(size=(model_dat["mdim"], tau)),
+                                             np.random.normal(size=(ndim, tau))),
+            "selwei": np.eye(ndim),
+            "alpha": 0.1,
+            })
+        hess, sec_inv = timed(estimate.sse_hess_alg, direct, model_dat)
+        model_dat["triangular"] = True
+        hess_tri, sec_tri = timed(estimate.sse_hess_alg, direct, model_dat)
+        print("{:20s} sse Hessian   inverse {:10f} s, triangular {:10f} s, max abs diff {:e}"
+              .format("", sec_inv, sec_tri, np.max(abs(hess - hess_tri))))
+
+def bench_kernels(ndims=(10, 100, 1000), ndim_max_vecmat=100):
+    """element wise utility kernels, Python loops against vectorized numpy,
+    vecmat of dimension (ndim * ndim, qdim) only up to ndim_max_vecmat"""
+
+    print("\nUtility kernels, loop vs. vectorized:")
+    for ndim in ndims:
+        eff = np.random.normal(size=(ndim, ndim))
+        std = abs(np.random.normal(size=(ndim, ndim))) * (np.random.rand(ndim, ndim) < 0.5)
+        std[0, 0] = np.nan
+        mz = np.tril(np.random.normal(size=(ndim, ndim)), -1) * (np.random.rand(ndim, ndim)
+                                                                 < min(0.3, 4 / ndim))
+        kernels = [("tvals", tvals_loop, utils.tvals, (eff, std)),
+                   ("digital", digital_loop, utils.digital, (std,)),
+                   ("colnorm", colnorm_loop, utils.colnorm, (mz,))]
+        if ndim <= ndim_max_vecmat:
+            kernels.append(("vecmat", vecmat_loop, utils.vecmat, (mz,)))
+        for name, func_loop, func_vec, args in kernels:
+            result_loop, sec_loop = timed(func_loop, *args)
+            result_vec, sec_vec = timed(func_vec, *args)
+            print("ndim {:4d}, {:8s} loop {:10f} s, vectorized {:10f} s, speedup {:8.1f}, "
+                  "identical {}".format(ndim, name, sec_loop, sec_vec, sec_loop / sec_vec,
+                                        np.array_equal(result_loop, result_vec, equal_nan=True)))
+
+def bench_ingest(nrows=(10**5, 10**6), ncols=10):
+    """data loading, parsing csv with loadtxt against converting once to npy
+    and memory mapping the cached binary array"""
+
+    print("\nData loading, loadtxt vs. npy conversion and memory mapped cache:")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for nrow in nrows:
+            csv_file = os.path.join(tmp_dir, "data{}.csv".format(nrow))
+            np.savetxt(csv_file, np.random.randint(0, 20, size=(nrow, ncols)), fmt="%d",
+                       delimiter=",")
+            data, sec_loadtxt = timed(np.loadtxt, csv_file, float, "#", ",")
+            data_conv, sec_conv = timed(ingest.load_csv, csv_file)
+            data_mmap, sec_mmap = timed(ingest.load_csv, csv_file)
+            print("nrows {:8d}, loadtxt {:10f} s, convert {:10f} s, cached {:10f} s, "
+                  "identical {}".format(nrow, sec_loadtxt, sec_conv, sec_mmap,
+                                        np.array_equal(data.T, data_mmap)))
+
+def bench_chunked(taus=(10**5, 10**6), chunk_size=10**4, repeats=5):
+    """model evaluation over observations of example model, all at once against
+    serial chunks, median seconds over repeats after warm-up compilation
+    and peak memory of temporaries"""
+
+    print("\nModel evaluation, all observations vs. chunked:")
+    model_dat = models.example()
+    model = utils.adjacency(model_dat)["model"]
+    for tau in taus:
+        xdat = np.random.normal(size=(len(model_dat["xvars"]), tau))
+        # compile model before timing
+        model(xdat[:, :10])
+        results = []
+        for name, opts in (("full", {"chunk_size": tau}), ("chunked", {"chunk_size": chunk_size})):
+            secs = [timed(utils.evaluate_chunked, model, xdat, opts)[1] for _ in range(repeats)]
+            tracemalloc.start()
+            yhat = utils.evaluate_chunked(model, xdat, opts)
+            peak = tracemalloc.get_traced_memory()[1] - yhat.nbytes
+            tracemalloc.stop()
+            results.append(yhat)
+            print("tau {:8d}, {:8s} {:10f} s, peak temporaries {:8.1f} MB"
+                  .format(tau, name, np.median(secs), peak / 1e6))
+        print("{:15s}identical {}".format("", np.array_equal(*results)))
+
+if __name__ == "__main__":
+
+    bench_effects_std()
+    bench_sparse()
+    bench_triangular()
+    bench_kernels()
+    bench_ingest()
+    bench_chunked()
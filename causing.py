@@ -4,6 +4,7 @@
 import models
 import estimate
 import indiv
+import export
 import graph
 import report
 import utils
@@ -17,6 +18,7 @@ def causing(model_dat):
     estimate_dat = estimate.estimate_models(model_dat)
     indiv_dat = indiv.create_indiv(model_dat)
     utils.print_output(model_dat, estimate_dat, indiv_dat)
+    export.export_effects(model_dat, estimate_dat, indiv_dat)
     graph_dat = graph.create_graphs(model_dat, estimate_dat, indiv_dat)
 
     analyze_dat = {
@@ -30,9 +32,7 @@ def causing(model_dat):
     # create pdf output files
     report.average_and_estimated_effects(analyze_dat)
     report.tvalues_and_biases(analyze_dat)
-    for individual_id in range(min(model_dat["tau"],
-                                   model_dat["show_nr_indiv"])):
-        report.mediation_effects(analyze_dat, individual_id)
+    report.individual_effects(analyze_dat)
     
     return analyze_dat
 
@@ -6,34 +6,199 @@
 
 import numdifftools as nd
 import numpy as np
-from copy import deepcopy
-from numpy import allclose, array_equal, diag, eye, linspace, zeros
-from numpy.linalg import cholesky, inv, LinAlgError
+import warnings
+from copy import copy
+from numpy import array_equal, diag, eye, linspace, zeros
+from numpy.linalg import cholesky, inv, LinAlgError, norm
+from scipy.linalg import cho_factor, cho_solve
+from scipy.optimize import minimize_scalar
 
 import utils
 
 
-def sse_hess_num(mx, my, model_dat):
-    """compute numeric Hessian of sse at given data and direct effects"""
-    
-    def sse_orig_alg(direct, model_dat):
-        direct = np.array(direct).reshape(-1)
-        mx, my = utils.directmat_alg(direct, model_dat["idx"], model_dat["idy"])
-        ex_hat, _ = utils.total_effects_alg(
-            mx, my, model_dat["edx"], model_dat["edy"])
-        ychat = ex_hat @ model_dat["xcdat"]
-        ymchat = model_dat["fym"] @ ychat
-        err = ymchat - model_dat["ymcdat"]
-        sse = np.sum(err * err * diag(model_dat["selwei"]).reshape(-1, 1))
-        ssetikh = sse + model_dat["alpha"] * direct.T @ direct
-        return ssetikh
-    direct = utils.directvec(mx, my, model_dat["idx"], model_dat["idy"])
-    direct = direct.detach().numpy()
-    hessian_num_func = nd.Hessian(lambda *direct: sse_orig_alg(direct, model_dat))
-    hessian_num = hessian_num_func(direct)
+def sse_orig_alg(direct, model_dat):
+    """weighted sse target function plus Tikhonov regularization term,
+    given direct effects vector"""
+
+    direct = np.array(direct).reshape(-1)
+    mx, my = utils.directmat_alg(direct, model_dat["idx"], model_dat["idy"],
+                                 model_dat.get("sparse", False), model_dat["direct_ind"])
+    ex_hat, _ = utils.total_effects_alg(
+        mx, my, model_dat["edx"], model_dat["edy"], model_dat.get("triangular", False))
+    sse = utils.sse_moments(utils.dense(ex_hat), model_dat["fym_ind"], model_dat["selwei"],
+                            model_dat["moments"])
+    ssetikh = sse + model_dat["alpha"] * direct.T @ direct
+
+    return ssetikh
+
+def sse_hess_num(mx, my, model_dat, ind=None):
+    """compute numeric Hessian of sse at given data and direct effects,
+    restricted to direct effects with vector indices ind if given"""
+
+    direct = utils.directvec_alg(mx, my, model_dat["idx"], model_dat["idy"],
+                                 direct_ind=model_dat["direct_ind"])
+    if ind is None:
+        ind = np.arange(len(direct))
+
+    def sse_ind(direct_ind):
+        direct_all = direct.copy()
+        direct_all[ind] = direct_ind
+        return sse_orig_alg(direct_all, model_dat)
+    hessian_num = nd.Hessian(sse_ind)(direct[ind])
+    hessian_num = np.reshape(hessian_num, (len(ind), len(ind)))
     
     return hessian_num
 
+def sse_grad_ex(ex, model_dat):
+    """gradient of weighted sse wrt. total effects ex from data moments,
+    grad_ex = 2 * (fym.T @ selwei @ (fym @ ex @ xx - yx)),
+    nonzero only in the rows fym_ind of manifest yvars"""
+
+    fym_ind = model_dat["fym_ind"]
+    wei = diag(model_dat["selwei"]).reshape(-1, 1)
+    grad_ex = zeros(ex.shape)
+    grad_ex[fym_ind] = 2 * wei * (ex[fym_ind] @ model_dat["moments"]["xx"]
+                                  - model_dat["moments"]["yx"])
+
+    return grad_ex
+
+def sse_grad_alg(direct, model_dat):
+    """compute algebraic gradient of sse at given data and direct effects
+
+    with ex = (I - my)^-1 @ mx and gradient wrt. ex
+        grad_ex = 2 * (fym.T @ selwei @ (fym @ ex @ xcdat - ymcdat) @ xcdat.T),
+    chain rule gives
+        grad_mx = (I - my)^-T @ grad_ex
+        grad_my = (I - my)^-T @ grad_ex @ ex.T
+    """
+
+    # for sparse direct effects, solve with sparse LU decomposition of (I - my)
+    # and gather gradient at identified direct effects only
+    if model_dat.get("sparse"):
+        mx, my = utils.directmat_alg(direct, model_dat["idx"], model_dat["idy"], sparse=True,
+                                     direct_ind=model_dat["direct_ind"])
+        lu = utils.splu_structural(my)
+        ex = lu.solve(mx.toarray())
+        grad_ex = sse_grad_ex(ex, model_dat)
+        c_ = lu.solve(grad_ex, trans="T")                     # (I - my)^-T @ grad_ex
+        iy, jy, ix, jx = model_dat["direct_ind"]
+        grad = (np.concatenate((np.sum(c_[iy] * ex[jy], axis=1), c_[ix, jx]))
+                + 2 * model_dat["alpha"] * direct)
+        return grad
+
+    mx, my = utils.directmat_alg(direct, model_dat["idx"], model_dat["idy"],
+                                 direct_ind=model_dat["direct_ind"])
+    if model_dat.get("triangular"):
+        # forward and backward substitution instead of inverse
+        ex = utils.solve_triangular_structural(my, mx)
+        grad_ex = sse_grad_ex(ex, model_dat)
+        grad_mx = utils.solve_triangular_structural(my, grad_ex, trans=True)
+    else:
+        i_ = inv(eye(model_dat["ndim"]) - my)
+        ex = i_ @ mx
+        grad_ex = sse_grad_ex(ex, model_dat)
+        grad_mx = i_.T @ grad_ex
+    grad_my = grad_mx @ ex.T
+
+    # gradient with tikhonov term
+    grad = (utils.directvec_alg(grad_mx, grad_my, model_dat["idx"], model_dat["idy"],
+                                direct_ind=model_dat["direct_ind"])
+            + 2 * model_dat["alpha"] * direct)
+
+    return grad
+
+def descent_step(direct, sse, grad, direction, model_dat):
+    """backtracking line search along descent direction until the Armijo condition,
+    sufficient decrease of sse, holds, returns step and new sse,
+    zero step if no decrease is found"""
+
+    # parameters
+    armijo = 1e-4 # ToDo: define globally
+    length_min = 1e-12 # ToDo: define globally
+
+    slope = grad @ direction
+    length = 1
+    while length >= length_min and slope < 0:
+        step = length * direction
+        sse_new = sse_orig_alg(direct + step, model_dat)
+        if sse_new <= sse + armijo * length * slope:
+            return step, sse_new
+        length /= 2
+
+    return zeros(len(direct)), sse
+
+def estimate_newton(model_dat, do_print=True, start=None):
+    """estimate direct effects in identified structural form
+    using damped Newton steps on the direct effects vector,
+    with algebraic gradient and algebraic Hessian
+
+    starting at given direct effects start = (mx, my),
+    or at theoretical direct effects if start is None,
+    the damping is increased only until the damped Hessian is positive-definite,
+    the step length along the Newton direction is found by backtracking line search,
+    falling back to a gradient step if the Newton direction does not decrease the sse,
+    warns if not converged within max_iter iterations"""
+
+    # parameters
+    rel = 1e-10 # ToDo: define globally
+    max_iter = 100 # ToDo: define globally
+
+    if start is None:
+        start = (model_dat["mx_theo"], model_dat["my_theo"])
+    direct = utils.directvec_alg(*start, model_dat["idx"], model_dat["idy"],
+                                 direct_ind=model_dat["direct_ind"])
+    sse = sse_orig_alg(direct, model_dat)
+    damp = 0
+    converged = False
+
+    if do_print:
+        print("\nEstimation of direct effects using damped Newton steps \n"
+              "with regularization parameter alpha = {:10f}:".format(model_dat["alpha"]))
+    for iteration in range(max_iter):
+        grad = sse_grad_alg(direct, model_dat)
+        hessian = sse_hess_alg(direct, model_dat)
+        scale = max(np.mean(abs(diag(hessian))), 1)
+        damp_min = 1e-12 * scale # ToDo: define globally
+        damp_max = 1e12 * scale # ToDo: define globally
+
+        # increase damping until damped Hessian is positive-definite
+        direction = None
+        while damp <= damp_max:
+            try:
+                chol = cho_factor(hessian + damp * eye(model_dat["qdim"]))
+                direction = -cho_solve(chol, grad)
+                break
+            except LinAlgError:
+                damp = max(10 * damp, damp_min)
+        step = zeros(model_dat["qdim"])
+        sse_new = sse
+        if direction is not None:
+            step, sse_new = descent_step(direct, sse, grad, direction, model_dat)
+        if not sse_new < sse:
+            # gradient step, scaled by the Hessian diagonal
+            step, sse_new = descent_step(direct, sse, grad, -grad / scale, model_dat)
+
+        direct = direct + step
+        sse_old = sse
+        sse = sse_new
+        damp = damp / 10
+        if do_print:
+            print("iteration {:>4}, sse {:10f}, param norm {:10f}"
+                  .format(iteration, sse, norm(direct)))
+        if abs(sse_old - sse) <= rel * abs(sse_old):
+            converged = True
+            break
+
+    if not converged:
+        warnings.warn("Newton estimation not converged within {} iterations, "
+                      "last relative sse decrease {:e}."
+                      .format(max_iter, abs(sse_old - sse) / abs(sse_old)), RuntimeWarning)
+
+    mx, my = utils.directmat_alg(direct, model_dat["idx"], model_dat["idy"],
+                                 direct_ind=model_dat["direct_ind"])
+
+    return mx, my, sse
+
 def sse_hess_alg(direct_hat, model_dat):
     """compute algebraic Hessian of sse at given data and direct effects
 
@@ -42,104 +207,51 @@ def sse_hess_alg(direct_hat, model_dat):
     note: sse hess depends on exogeneous data and on direct effects,
           but it does not depend explicitely on tau nor requires a minimum tau
     keyword: target/gradient/hessian function
+
+    with i_ = (I - my)^-1, ex = i_ @ mx, a_ = i_.T @ fym.T @ selwei @ fym @ i_,
+    c_ = i_.T @ grad_ex (see sse_grad_alg) and d_ = c_ @ ex.T,
+    each Hessian element wrt. direct effects (k, l) and (i, j) is a sum of products
+    of two matrix elements, e.g. for (k, l), (i, j) both in my:
+        d_[i, l] * i_[j, k] + 2 * (ex @ xx @ ex.T)[j, l] * a_[k, i] + i_[l, i] * d_[k, j],
+    so the Hessian is gathered at once from the row and column indices
+    of all identified direct effects, instead of Kronecker products
     """
 
-    mx, my = utils.directmat_alg(direct_hat, model_dat["idx"], model_dat["idy"])
-
-    # define matrices for computation of Hessian
-    xcdatxcdatT = model_dat["xcdat"] @ model_dat["xcdat"].T
-    ymcdatxcdatT = model_dat["ymcdat"] @ model_dat["xcdat"].T
-    i_ = inv(eye(model_dat["ndim"]) - my)
-    a_ = model_dat["fym"] @ i_
-    e_ = model_dat["fym"].T @ model_dat["selwei"] @ ymcdatxcdatT @ mx.T
-    g_ = model_dat["fym"].T @ model_dat["selwei"] @ model_dat["fym"]
-    h_ = mx @ xcdatxcdatT @ mx.T
-
-    # define further resused matrix products
-    gihiT = g_ @ i_ @ h_ @ i_.T
-    iTg = i_.T @ g_
-    hiT = h_ @ i_.T
-    iTgih = i_.T @ g_ @ i_ @ h_
-    iTe = i_.T @ e_
-    eiT = e_ @ i_.T
-
-    hessian_sse = zeros((model_dat["qdim"], model_dat["qdim"]))
-    # loop quadrant, row wise [[0, 1], [2, 3]]
-    for quad in range(4):
-        if quad == 0:
-            qrowstart = 0
-            qcolstart = 0
-            irows = model_dat["ndim"]
-            jcols = model_dat["ndim"]
-            krows = model_dat["ndim"]
-            lcols = model_dat["ndim"]
-            qrows = model_dat["qydim"]
-        if quad == 1:
-            qrowstart = 0
-            qcolstart = model_dat["qydim"]
-            irows = model_dat["ndim"]
-            jcols = model_dat["mdim"]
-            krows = model_dat["ndim"]
-            lcols = model_dat["ndim"]
-            qrows = model_dat["qydim"]
-        if quad == 2:
-            qrowstart = model_dat["qydim"]
-            qcolstart = 0
-            irows = model_dat["ndim"]
-            jcols = model_dat["ndim"]
-            krows = model_dat["ndim"]
-            lcols = model_dat["mdim"]
-            qrows = model_dat["qxdim"]
-        if quad == 3:
-            qrowstart = model_dat["qydim"]
-            qcolstart = model_dat["qydim"]
-            irows = model_dat["ndim"]
-            jcols = model_dat["mdim"]
-            krows = model_dat["ndim"]
-            lcols = model_dat["mdim"]
-            qrows = model_dat["qxdim"]
-        # i, j correspond to cols of Hessian, denominator of derivative
-        # iterating column wise, corresponding to vec of direct effects
-        qcol = qcolstart
-        for j in range(jcols):
-            for i in range(irows):
-                if quad == 0:
-                    jijy = zeros((model_dat["ndim"], model_dat["ndim"]))
-                    jijy[i, j] = 1
-                    f_ = i_ @ jijy @ i_
-                    hess = 2 * ((f_.T @ gihiT + iTg @ f_ @ hiT + iTgih @ f_.T)
-                                - (iTe @ f_.T + f_.T @ eiT))
-                if quad == 1:
-                    jijx = zeros((model_dat["ndim"], model_dat["mdim"]))
-                    jijx[i, j] = 1
-                    d_ = jijx @ xcdatxcdatT @ mx.T
-                    hess = 2 * (a_.T @ model_dat["selwei"] @
-                                (a_ @ (d_.T + d_) - ymcdatxcdatT @ jijx.T) @ i_.T)
-                if quad == 2:
-                    jijy = zeros((model_dat["ndim"], model_dat["ndim"]))
-                    jijy[i, j] = 1
-                    c_ = model_dat["selwei"] @ a_ @ jijy @ i_
-                    hess = 2 * ((a_.T @ c_ + c_.T @ a_) @ mx @ xcdatxcdatT
-                                - c_.T @ ymcdatxcdatT)
-                if quad == 3:
-                    jijx = zeros((model_dat["ndim"], model_dat["mdim"]))
-                    jijx[i, j] = 1
-                    b_ = model_dat["selwei"] @ a_ @ jijx
-                    hess = 2 * (a_.T @ b_ @ xcdatxcdatT)
-                # k, l correspond to rows of Hessian, numerator of derivative
-                # iterating column wise, corresponding to vec of direct effects
-                qrow = qrowstart
-                for l in range(lcols):
-                    for k in range(krows):
-                        if ((quad == 0 and model_dat["idy"][k, l] and model_dat["idy"][i, j])
-                                or (quad == 1 and model_dat["idy"][k, l] and model_dat["idx"][i, j])
-                                or (quad == 2 and model_dat["idx"][k, l] and model_dat["idy"][i, j])
-                                or (quad == 3 and model_dat["idx"][k, l] and model_dat["idx"][i, j])):
-                            hessian_sse[qrow, qcol] = hess[k, l]
-                            qrow += 1
-                if qrow == qrowstart + qrows:
-                    qrow = qrowstart
-                    qcol += 1
+    mx, my = utils.directmat_alg(direct_hat, model_dat["idx"], model_dat["idy"],
+                                 direct_ind=model_dat["direct_ind"])
+
+    # define matrices for computation of Hessian, using data moments
+    xcdatxcdatT = model_dat["moments"]["xx"]
+    if model_dat.get("sparse"):
+        i_ = utils.splu_structural(utils.csc_matrix(my)).solve(eye(model_dat["ndim"]))
+    elif model_dat.get("triangular"):
+        i_ = utils.solve_triangular_structural(my, eye(model_dat["ndim"]))
+    else:
+        i_ = inv(eye(model_dat["ndim"]) - my)
+    ex = i_ @ mx
+    grad_ex = sse_grad_ex(ex, model_dat)
+    wei = diag(model_dat["selwei"]).reshape(-1, 1)
+    i_m = i_[model_dat["fym_ind"]]                              # (pdim x ndim)
+    a_ = i_m.T @ (wei * i_m)                                    # (ndim x ndim)
+    c_ = i_.T @ grad_ex                                         # (ndim x mdim)
+    d_ = c_ @ ex.T                                              # (ndim x ndim)
+    e_ = ex @ xcdatxcdatT                                       # (ndim x mdim)
+    f_ = e_ @ ex.T                                              # (ndim x ndim)
+
+    # row and column indices of identified direct effects,
+    # iterating column wise, corresponding to vec of direct effects
+    ky, ly, kx, lx = model_dat["direct_ind"]
+    # k, l correspond to rows of Hessian, numerator of derivative, as column vectors
+    # i, j correspond to cols of Hessian, denominator of derivative, as row vectors
+    ky_, ly_, kx_, lx_ = (ind.reshape(-1, 1) for ind in (ky, ly, kx, lx))
+
+    # quadrants, row wise [[yy, yx], [xy, xx]]
+    hess_yy = (d_[ky, ly_] * i_[ly, ky_] + 2 * f_[ly, ly_] * a_[ky_, ky]
+               + i_[ly_, ky] * d_[ky_, ly])
+    hess_yx = 2 * e_[ly_, lx] * a_[ky_, kx] + i_[ly_, kx] * c_[ky_, lx]
+    hess_xy = c_[ky, lx_] * i_[ly, kx_] + 2 * e_[ly, lx_] * a_[kx_, ky]
+    hess_xx = 2 * xcdatxcdatT[lx, lx_] * a_[kx_, kx]
+    hessian_sse = np.block([[hess_yy, hess_yx], [hess_xy, hess_xx]])
 
     # Hessian with tikhonov term
     hessian = hessian_sse + 2 * model_dat["alpha"] * eye(model_dat["qdim"])
@@ -149,6 +261,25 @@ def sse_hess_alg(direct_hat, model_dat):
 
     return hessian
 
+def sse_hess_alg_mat(mx, my, model_dat, ind=None):
+    """compute algebraic Hessian of sse at given data and direct effects matrices,
+    restricted to direct effects with vector indices ind if given"""
+
+    direct = utils.directvec_alg(mx, my, model_dat["idx"], model_dat["idy"],
+                                 direct_ind=model_dat["direct_ind"])
+    hessian = sse_hess_alg(direct, model_dat)
+    if ind is not None:
+        hessian = hessian[np.ix_(ind, ind)]
+
+    return hessian
+
+# Hessian backends: sse Hessian wrt. direct effects, given mx, my and model_dat
+HESSIANS = {
+    "alg": sse_hess_alg_mat,    # algebraic
+    "auto": utils.sse_hess,     # automatic, PyTorch
+    "num": sse_hess_num,        # numeric, numdifftools
+    }
+
 def check_hessian(hessian_hat):
     """check algebraic Hessian matrix of target function with respect to
     direct effects at given data and estimated direct effects"""
@@ -175,21 +306,45 @@ def compute_cov_direct(sse_hat, hessian_hat, model_dat):
     
     return cov_direct
 
-def check_estimate_effects(model_dat, do_print=True):
-    """estimate structural model given alpha in model_dat"""
+def check_estimate_effects(model_dat, do_print=True, start=None):
+    """estimate structural model given alpha in model_dat,
+    starting at given direct effects start = (mx, my) or at theoretical direct effects"""
 
-    mx_hat, my_hat, sse_hat = utils.estimate_snn(model_dat, do_print)
+    solver = model_dat.get("solver", "rprop")
+    if solver in ("rprop", "minibatch"):
+        mx_hat, my_hat, sse_hat = utils.estimate_snn(model_dat, do_print, start)
+    elif solver == "newton":
+        mx_hat, my_hat, sse_hat = estimate_newton(model_dat, do_print, start)
+    else:
+        raise ValueError("Unknown solver {}, use 'rprop', 'minibatch' or 'newton'."
+                         .format(solver))
 
-    ex_hat, ey_hat = utils.total_effects_alg(mx_hat, my_hat, model_dat["edx"], model_dat["edy"])
-    direct_hat = utils.directvec(mx_hat, my_hat, model_dat["idx"], model_dat["idy"])
+    ex_hat, ey_hat = utils.total_effects(mx_hat, my_hat, model_dat["edx"], model_dat["edy"],
+                                         model_dat.get("sparse", False),
+                                         model_dat.get("triangular", False))
+    direct_hat = utils.directvec_alg(mx_hat, my_hat, model_dat["idx"], model_dat["idy"],
+                                     direct_ind=model_dat["direct_ind"])
 
-    hessian_hat = sse_hess_alg(direct_hat, model_dat)
+    hessian_hat = utils.backend(HESSIANS, "hessian_backend", "alg", model_dat)(
+        mx_hat, my_hat, model_dat)
     check = check_hessian(hessian_hat)
     if check and do_print:
         print("Hessian is well conditioned.")
 
     return check, hessian_hat, direct_hat, sse_hat, mx_hat, my_hat, ex_hat, ey_hat
 
+def nearest_start(alpha, solved):
+    """direct effects (mx, my) of already solved alpha nearest on log scale,
+    as starting values for estimation, None if nothing solved yet"""
+
+    if not solved:
+        return None
+    tiny = 1e-12 # ToDo: define globally, offset for alpha = 0
+    alpha_near = min(solved, key=lambda alpha_solved:
+                     abs(np.log((alpha_solved + tiny) / (alpha + tiny))))
+
+    return solved[alpha_near]
+
 def alpha_min_max(model_dat):
     """estimate minimal alpha ensuring positive-definite Hessian
     and give maximal alpha to search over
@@ -197,16 +352,20 @@ def alpha_min_max(model_dat):
     starting at regularization tikh (= alpha * directnorm)
     being a certain fraction of observed y variance."""
     
+    # for adaptive alpha search, warm start at nearest solved alpha
+    warm = model_dat.get("alpha_search", "grid") == "adaptive"
+    solved = {}
+
     # alpha_max_tmp
     fraction = 0.002 # ToDo: define globally
-    ymvar = np.sum(model_dat["ymcdat"] * model_dat["ymcdat"] *
-                   diag(model_dat["selwei"]).reshape(-1, 1))    
+    ymvar = np.sum(diag(model_dat["selwei"]) * diag(model_dat["moments"]["yy"]))
     directnorm = model_dat["direct_theo"].T @ model_dat["direct_theo"]
     alpha_max_tmp = fraction * ymvar / directnorm
     
     # try without regularization
     model_dat["alpha"] = 0
-    check, *_ = check_estimate_effects(model_dat, do_print=True)
+    check, *_, mx_hat, my_hat, _, _ = check_estimate_effects(model_dat, do_print=True)
+    solved[0] = (mx_hat, my_hat)
     if check:
         print("\nModel identified without regularization.")
         return 0, alpha_max_tmp
@@ -224,7 +383,10 @@ def alpha_min_max(model_dat):
     print("\nEstimation of minimal regularization parameter alpha:")
     while (alpha_max_tmp - alpha_min_tmp) / alpha > rel and alpha > absol:
         model_dat["alpha"] = alpha
-        check, *_ = check_estimate_effects(model_dat, do_print=False)
+        start = nearest_start(alpha, solved) if warm else None
+        check, *_, mx_hat, my_hat, _, _ = check_estimate_effects(
+            model_dat, do_print=False, start=start)
+        solved[alpha] = (mx_hat, my_hat)
         print("alpha: {:10f}, Hessian OK: {}".format(alpha, bool(check)))
         # accept new alpha if Hessian is well conditioned
         if check is False:
@@ -241,88 +403,235 @@ def alpha_min_max(model_dat):
     
     return alpha_min, alpha_max
 
-def estimate_alpha(alpha_min, alpha_max, model_dat):
-    """estimate optimal alpha minimizing out-of-sample SSE via grid search"""
-    
-    model_dat_train = deepcopy(model_dat)
-    
+def estimate_sse_alpha(alpha, model_dat_train, moments_out, start=None):
+    """estimate direct effects given alpha with in-sample training data,
+    and compute out-of-sample SSE and dof
+
+    training data moments are in model_dat_train, test data moments in moments_out"""
+
+    model_dat_train = copy(model_dat_train)
+    model_dat_train["alpha"] = alpha
+    (check, _, _, _, mx_hat, my_hat, ex_hat, _
+     ) = check_estimate_effects(model_dat_train, do_print=False, start=start)
+
+    # ToDo: sse in-sample and sse out-of-sample depend on how big companies are:
+    # use base_var for data normalization before estimation # yyyy
+
+    # in-sample mse
+    moments_in = model_dat_train["moments"]
+    inabs = moments_in["tau"]
+    selwei = model_dat_train["selwei"]
+    sse_in = utils.sse_moments(ex_hat, model_dat_train["fym_ind"], selwei, moments_in)
+    mse_in = sse_in / inabs
+
+    # in-sample mse, central, subtracting mean error from moments
+    err_mean_in = ((ex_hat @ moments_in["xsum"])[model_dat_train["fym_ind"]]
+                   - moments_in["ysum"]) / inabs
+    sse_central_in = sse_in - inabs * np.sum(diag(selwei) * err_mean_in**2)
+    mse_central_in = sse_central_in / inabs
+
+    # out-of-sample mse, for out-of-sample test data
+    sse = utils.sse_moments(ex_hat, model_dat_train["fym_ind"], selwei, moments_out)
+    mse = sse / moments_out["tau"]
+
+    # dof, Tibshirani (2015), "Degrees of Freedom and Model Search", eq. (5)
+    dof = (mse - mse_in) / (2 * mse_central_in)
+    dof = min(max(dof, 0), model_dat_train["qdim"])
+
+    return check, sse, mse, dof, mx_hat, my_hat
+
+def print_sse_alpha(alpha, check, mse, dof):
+    """print out-of-sample mse and dof given alpha"""
+
+    print("alpha: {:10f}, Hessian OK: {:5s}, out-of-sample mse: {:10f}, dof: {:10f}"
+          .format(alpha, str(bool(check)), mse, dof))
+
+def check_alpha(alpha, model_dat, start=None):
+    """check Hessian of structural model estimated given alpha with full data"""
+
+    model_dat = copy(model_dat)
+    model_dat["alpha"] = alpha
+    check, *_ = check_estimate_effects(model_dat, do_print=False, start=start)
+
+    return check
+
+def split_data(model_dat):
+    """split data into training and test data for out-of-sample SSE,
+    given by cv_folds in model_dat
+
+    if cv_folds is None, the first 70% of observations are training data,
+    for K = cv_folds, randomly permuted observations are split into K folds,
+    each fold being test data once, with training data moments
+    obtained by subtracting the test fold moments from the full data moments
+
+    returns list of splits (model_dat_train, moments_out),
+    model_dat_train containing training data moments"""
+
     inrel = 0.7     # percentage of in-sample training observations
+    cv_folds = model_dat.get("cv_folds")
+
+    if cv_folds is None:
+        # for in-sample and out-of-sample SSE, data moments computed once per split
+        inabs = int(inrel * model_dat["tau"])
+        moments_in = utils.compute_moments(model_dat["xcdat"][:, :inabs],
+                                           model_dat["ymcdat"][:, :inabs])
+        moments_out = utils.compute_moments(model_dat["xcdat"][:, inabs:],
+                                            model_dat["ymcdat"][:, inabs:])
+
+        # for in-sample estimation, data is not copied
+        model_dat_train = copy(model_dat)
+        model_dat_train["xcdat"] = model_dat["xcdat"][:, :inabs]
+        model_dat_train["ymcdat"] = model_dat["ymcdat"][:, :inabs]
+        model_dat_train["moments"] = moments_in
+
+        return [(model_dat_train, moments_out)]
+
+    if not 2 <= cv_folds <= model_dat["tau"]:
+        raise ValueError("cv_folds must be between 2 and the number of observations {}, "
+                         "or None for a single split, got {}.".format(model_dat["tau"], cv_folds))
+    splits = []
+    folds = np.array_split(np.random.permutation(model_dat["tau"]), cv_folds)
+    for fold in folds:
+        fold = np.sort(fold)
+        moments_out = utils.compute_moments(model_dat["xcdat"][:, fold],
+                                            model_dat["ymcdat"][:, fold])
+        model_dat_train = utils.picklable(model_dat, obs=False)
+        model_dat_train["moments"] = utils.subtract_moments(model_dat["moments"], moments_out)
+        splits.append((model_dat_train, moments_out))
+
+    return splits
+
+def estimate_sse_alphas(alphas, splits, model_dat, solved=None):
+    """estimate out-of-sample SSE and dof for each alpha, given splits into training
+    and test data, all estimations in parallel if nr_workers > 1 in model_dat
+
+    the SSE is summed and the dof is averaged over splits,
+    the Hessian check requires well conditioned Hessians for all splits,
+    if solved is given, a list of dicts of in-sample estimated direct effects (mx, my)
+    per alpha for each split, estimations start at nearest already solved alpha
+    and solved is updated
+
+    returns dict of Hessian check, out-of-sample SSE and dof per alpha"""
+
+    splits_send = [(utils.picklable(model_dat_train, obs=False), moments_out)
+                   for model_dat_train, moments_out in splits]
+    tasks = [(alpha, model_dat_train, moments_out,
+              nearest_start(alpha, solved[k]) if solved is not None else None)
+             for alpha in alphas
+             for k, (model_dat_train, moments_out) in enumerate(splits_send)]
+    results = utils.map_parallel(estimate_sse_alpha, tasks, model_dat)
+
+    tau_out = sum(moments_out["tau"] for _, moments_out in splits)
+    probes = {}
+    for i, alpha in enumerate(alphas):
+        checks, sses, _, dofs, mx_hats, my_hats = zip(
+            *results[i * len(splits):(i + 1) * len(splits)])
+        check = all(checks)
+        sse = sum(sses)
+        mse = sse / tau_out
+        dof = np.mean(dofs)
+        if solved is not None:
+            for k, start in enumerate(zip(mx_hats, my_hats)):
+                solved[k][alpha] = start
+        print_sse_alpha(alpha, check, mse, dof)
+        probes[alpha] = (check, sse, dof)
+
+    return probes
+
+def search_alpha_grid(alpha_min, alpha_max, splits, model_dat):
+    """estimate out-of-sample SSE on equally spaced grid of alphas,
+    each estimation starting at theoretical direct effects"""
+
     num = 10        # number of alphas to search over
-    
-    # for in-sample and out-of-sample SSE
-    inabs = int(inrel * model_dat["tau"])
-    xc_in = model_dat_train["xcdat"][:, :inabs]
-    ymc_in = model_dat_train["ymcdat"][:, :inabs]
-    xc_out = model_dat_train["xcdat"][:, inabs:]
-    ymc_out = model_dat_train["ymcdat"][:, inabs:]
-    
-    # for in-sample estimation
-    model_dat_train["xcdat"] = model_dat_train["xcdat"][:, :inabs]
-    model_dat_train["ymcdat"] = model_dat_train["ymcdat"][:, :inabs]
 
+    alphas = linspace(alpha_min, alpha_max, num=num)
+    probes = estimate_sse_alphas(alphas, splits, model_dat)
+
+    return probes
+
+def search_alpha_adaptive(alpha_min, alpha_max, splits, model_dat, solved, probes):
+    """estimate out-of-sample SSE at alphas chosen by bounded Brent search on log alpha,
+    each estimation starting at nearest already solved alpha
+
+    alpha_max is probed as well, alpha_min only if it is zero,
+    solved and probes are updated, see estimate_sse_alphas"""
+
+    xatol = 0.1 # ToDo: define globally, relative tolerance of alpha
+    low = 1e-4 # ToDo: define globally, lowest alpha_max fraction if alpha_min = 0
+
+    def probe(alpha):
+        if alpha not in probes:
+            probes.update(estimate_sse_alphas([alpha], splits, model_dat, solved))
+        return probes[alpha][1]
+
+    if alpha_min == 0:
+        probe(alpha_min)
+        alpha_min = low * alpha_max
+    probe(alpha_max)
+    minimize_scalar(lambda log_alpha: probe(np.exp(log_alpha)),
+                    bounds=(np.log(alpha_min), np.log(alpha_max)),
+                    method="bounded", options={"xatol": xatol})
+
+    return probes
+
+def estimate_alpha(alpha_min, alpha_max, model_dat):
+    """estimate optimal alpha minimizing out-of-sample SSE,
+    via grid search or adaptive search given by alpha_search in model_dat,
+    out-of-sample SSE with single split or cross-validation given by cv_folds"""
+    
+    alpha_search = model_dat.get("alpha_search", "grid")
+    if alpha_search not in ("grid", "adaptive"):
+        raise ValueError("Unknown alpha_search {}, use 'grid' or 'adaptive'."
+                         .format(alpha_search))
+    splits = split_data(model_dat)
+
+    # in-sample estimated direct effects per alpha for each split, for warm start
+    solved = [{} for _ in splits]
+    probes = {} # Hessian check, out-of-sample sse and dof per alpha
     found_alpha = False
     while not found_alpha:
         print("\nalpha_min, alpha_max to search over: [{:10f} {:10f}]"
               .format(alpha_min, alpha_max))
-        alphas = linspace(alpha_min, alpha_max, num=num)
+        if alpha_search == "grid":
+            probes = search_alpha_grid(alpha_min, alpha_max, splits, model_dat)
+        else:
+            probes = search_alpha_adaptive(alpha_min, alpha_max, splits, model_dat,
+                                           solved, probes)
         mses_ok = []
         alphas_ok = []
         dofs_ok = []
-        for alpha in alphas:
-            model_dat_train["alpha"] = alpha
-            (check, _, _, _, _, _, ex_hat, _
-             ) = check_estimate_effects(model_dat_train, do_print=False) # in-sample train data
-            
-            # ToDo: sse in-sample and sse out-of-sample depend on how big companies are:
-            # use base_var for data normalization before estimation # yyyy
-            
-            # in-sample mse
-            ychat_in = ex_hat @ xc_in
-            ymchat_in = model_dat_train["fym"] @ ychat_in
-            err_in = ymchat_in - ymc_in
-            sse_in = np.sum(err_in * err_in * diag(model_dat_train["selwei"]).reshape(-1, 1))
-            mse_in = sse_in / inabs
-            
-            # in-sample mse, central
-            err_central_in = err_in - np.mean(err_in, axis=1).reshape(-1, 1)
-            sse_central_in = np.sum(err_central_in * err_central_in * diag(model_dat_train["selwei"]).reshape(-1, 1))
-            mse_central_in = sse_central_in / inabs
-                        
-            # out-of-sample mse, for out-of-sample test data
-            ychat = ex_hat @ xc_out
-            ymchat = model_dat_train["fym"] @ ychat
-            err = ymchat - ymc_out
-            sse = np.sum(err * err * diag(model_dat_train["selwei"]).reshape(-1, 1))
-            mse = sse / (model_dat["tau"] - inabs)
-            
-            # dof, Tibshirani (2015), "Degrees of Freedom and Model Search", eq. (5)
-            dof = (mse - mse_in) / (2 * mse_central_in)
-            dof = min(max(dof, 0), model_dat["qdim"])
-            
+        for alpha, (check, sse, dof) in sorted(probes.items()):
             if check:
                 mses_ok.append(sse)
                 alphas_ok.append(alpha)
                 dofs_ok.append(dof)
-            print("alpha: {:10f}, Hessian OK: {:5s}, out-of-sample mse: {:10f}, dof: {:10f}"
-                  .format(alpha, str(bool(check)), mse, dof))
         
         # check that full data Hessian is also positive-definite
         # sort by mses_ok
         if len(alphas_ok) > 0:
             mses_ok, alphas_ok, dofs_ok = zip(*sorted(zip(mses_ok, alphas_ok, dofs_ok)))
+            # in chunks of nr_workers estimations in parallel
             print("\ncheck alpha with full data:")
-            for i, alpha in enumerate(alphas_ok):
-                model_dat["alpha"] = alpha
-                check, *_ = check_estimate_effects(model_dat, do_print=False) # full data
-                dof = dofs_ok[i]
-                print("alpha: {:10f}, dof: {:10f}, Hessian OK: {:5s}"
-                      .format(alpha, dof, str(bool(check))))
+            chunk = max(model_dat.get("nr_workers", 1), 1)
+            model_dat_send = utils.picklable(model_dat, obs=False)
+            for i in range(0, len(alphas_ok), chunk):
+                checks = utils.map_parallel(
+                    check_alpha, [(alpha, model_dat_send, solved[0].get(alpha))
+                                  for alpha in alphas_ok[i:i + chunk]], model_dat) # full data
+                for alpha, dof, check in zip(alphas_ok[i:i + chunk], dofs_ok[i:i + chunk],
+                                             checks):
+                    print("alpha: {:10f}, dof: {:10f}, Hessian OK: {:5s}"
+                          .format(alpha, dof, str(bool(check))))
+                    if check:
+                        break
                 if check:
                     break
     
         # no alpha found or optimal alpha is alpha_max
         if not check or alpha == alpha_max:
             print("Increase alpha_max.")
+            if alpha_search == "adaptive": # smaller alphas already searched
+                alpha_min = alpha_max
             alpha_max *= 10
             found_alpha = False
         else:
@@ -355,23 +664,15 @@ def estimate_effects(model_dat):
               .format(model_dat["alpha"], model_dat["dof"]))
 
     # final estimation given optimal alpha
-    # algebraic Hessian
     (check, hessian_hat, direct_hat, sse_hat, mx_hat, my_hat, ex_hat, ey_hat
      ) = check_estimate_effects(model_dat)
-    # automatic Hessian
-    hessian = utils.sse_hess(mx_hat, my_hat, model_dat)
-    # numeric Hessian
-    hessian_num = sse_hess_num(mx_hat, my_hat, model_dat)
-    
-    print("\nAlgebraic and numeric   Hessian allclose: {} with accuracy {:10f}."
-          .format(allclose(hessian_hat, hessian_num),
-                  utils.acc(hessian_hat, hessian_num)))
-    print("Automatic and numeric   Hessian allclose: {} with accuracy {:10f}."
-          .format(allclose(hessian, hessian_num),
-                  utils.acc(hessian, hessian_num)))
-    print("Automatic and algebraic Hessian allclose: {} with accuracy {:10f}."
-          .format(allclose(hessian, hessian_hat),
-                  utils.acc(hessian, hessian_hat)))
+
+    # optionally cross-check Hessian and effects Jacobian backends
+    if model_dat.get("compare_backends"):
+        utils.compare_backends(HESSIANS, "hessian_backend", "alg", "Hessian",
+                               (mx_hat, my_hat, model_dat), model_dat)
+        utils.compare_backends(utils.JACOBIANS, "jacobian_backend", "struct", "Jacobian",
+                               (direct_hat, model_dat), model_dat)
     
     assert check, "Hessian not well conditioned."
     cov_direct_hat = compute_cov_direct(sse_hat, hessian_hat, model_dat)
@@ -410,20 +711,49 @@ def estimate_effects(model_dat):
 
     return estimate_dat
 
+def estimate_bias(bias_ind, model_dat, do_print=True):
+    """numerical optimize modification indicator for single equation,
+    returns bias and its standard deviation
+
+    if model_dat contains no compiled model, e.g. in a worker process,
+    the model is compiled from the algebraic equations"""
+
+    if "bias_derivs" not in model_dat:
+        model_dat = copy(model_dat)
+        model_dat["bias_derivs"] = utils.numeric_bias_derivs(
+            model_dat["equations"], model_dat["xvars"], model_dat["yvars"])
+
+    # compute bias
+    bias, hess_i, sse = utils.optimize_biases(model_dat, bias_ind, do_print)
+
+    # compute bias_std
+    resvar = sse / (model_dat["tau"] - 1)
+    bias_std = (2 * resvar * (1 / hess_i))**(1/2)
+
+    return bias, bias_std
+
 def estimate_biases(model_dat):
-    """numerical optimize modification indicators for equations, one at a time"""
+    """numerical optimize modification indicators for equations, one at a time,
+    in parallel if nr_workers > 1 in model_dat"""
+
+    parallel = model_dat.get("nr_workers", 1) > 1
+    if parallel and model_dat.get("pool", "process") == "process":
+        # compiled model is not passed to worker processes, but compiled per worker
+        model_dat_send = utils.picklable(model_dat)
+    else:
+        model_dat_send = model_dat
+    results = utils.map_parallel(
+        estimate_bias, [(bias_ind, model_dat_send, not parallel)
+                        for bias_ind in range(model_dat["ndim"])], model_dat)
 
     biases = zeros(model_dat["ndim"])
     biases_std = zeros(model_dat["ndim"])
-    for bias_ind in range(model_dat["ndim"]):
-        # compute biases
-        bias, hess_i, sse = utils.optimize_biases(model_dat, bias_ind)
+    for bias_ind, (bias, bias_std) in enumerate(results):
         biases[bias_ind] = bias
-
-        # compute biases_std
-        resvar = sse / (model_dat["tau"] - 1)
-        bias_std = (2 * resvar * (1 / hess_i))**(1/2)
         biases_std[bias_ind] = bias_std
+        if parallel:
+            print("\nEstimation of bias for {}: bias {:10f}, bias std {:10f}"
+                  .format(model_dat["yvars"][bias_ind], float(bias), float(bias_std)))
 
     return biases, biases_std
 
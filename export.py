@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""Export individual, average and estimated effects in long columnar form."""
+
+import json
+import os
+
+import numpy as np
+from numpy import eye, nan
+from pandas import Categorical, DataFrame
+
+# effect types named as graphs: average (A), estimated (E) and individual (I)
+# direct (DE), total (TE) and mediation (ME) effects
+EFFECT_TYPES = ("ADE", "ATE", "AME", "EDE", "ETE", "EME", "IDE", "ITE", "IME")
+
+# long form columns, source, target and effect_type as codes of categories
+COLUMNS = ("individual", "source", "target", "effect_type", "value", "std")
+CATEGORICAL = ("source", "target", "effect_type")
+
+
+def effect_columns(effect_type, effects_x, effects_y, id_x, id_y, std_x=None, std_y=None):
+    """columns of identified effects of one type, of shape (individuals, effects),
+    a single row with individual -1 for average and estimated effects,
+    variable codes are xvars first, then yvars, self effects of yvars are omitted"""
+
+    mdim = id_x.shape[1]
+    id_y = id_y * (1 - eye(id_y.shape[0]))
+
+    parts = {key: [] for key in COLUMNS}
+    for effects, id_mat, std, offset in ((effects_x, id_x, std_x, 0),
+                                         (effects_y, id_y, std_y, mdim)):
+        target, source = np.nonzero(id_mat)
+        values = np.asarray(effects)[..., target, source].reshape(-1, len(target))
+        parts["source"].append(np.broadcast_to(source + offset, values.shape))
+        parts["target"].append(np.broadcast_to(target + mdim, values.shape))
+        parts["value"].append(values)
+        if std is None:
+            parts["std"].append(np.full(values.shape, nan))
+        else:
+            parts["std"].append(np.broadcast_to(std[target, source], values.shape))
+    columns = {key: np.hstack(part) for key, part in parts.items() if part}
+
+    nr_rows, nr_effects = columns["value"].shape
+    individuals = np.arange(nr_rows) if np.ndim(effects_x) == 3 else np.array([-1])
+    columns["individual"] = np.repeat(individuals.reshape(-1, 1), nr_effects, axis=1)
+    columns["effect_type"] = np.full((nr_rows, nr_effects), EFFECT_TYPES.index(effect_type))
+
+    return columns
+
+def effects_long(model_dat, estimate_dat, indiv_dat):
+    """long form columns of average, estimated and individual effects,
+    average and estimated effects first, then effects ordered by individual,
+    each individual with nr_rows_indiv rows starting at offset_indiv + i * nr_rows_indiv"""
+
+    aggregate = [
+        effect_columns("ADE", model_dat["mx_theo"], model_dat["my_theo"],
+                       model_dat["idx"], model_dat["idy"]),
+        effect_columns("ATE", model_dat["ex_theo"], model_dat["ey_theo"],
+                       model_dat["edx"], model_dat["edy"]),
+        effect_columns("AME", model_dat["eyx_theo"], model_dat["eyy_theo"],
+                       model_dat["fdx"], model_dat["fdy"]),
+        effect_columns("EDE", estimate_dat["mx_hat"], estimate_dat["my_hat"],
+                       model_dat["idx"], model_dat["idy"],
+                       estimate_dat["mx_hat_std"], estimate_dat["my_hat_std"]),
+        effect_columns("ETE", estimate_dat["ex_hat"], estimate_dat["ey_hat"],
+                       model_dat["edx"], model_dat["edy"],
+                       estimate_dat["ex_hat_std"], estimate_dat["ey_hat_std"]),
+        effect_columns("EME", estimate_dat["eyx_hat"], estimate_dat["eyy_hat"],
+                       model_dat["fdx"], model_dat["fdy"],
+                       estimate_dat["eyx_hat_std"], estimate_dat["eyy_hat_std"]),
+        ]
+    individual = [
+        effect_columns("IDE", indiv_dat["mx_indivs"], indiv_dat["my_indivs"],
+                       model_dat["idx"], model_dat["idy"]),
+        effect_columns("ITE", indiv_dat["ex_indivs"], indiv_dat["ey_indivs"],
+                       model_dat["edx"], model_dat["edy"]),
+        effect_columns("IME", indiv_dat["eyx_indivs"], indiv_dat["eyy_indivs"],
+                       model_dat["fdx"], model_dat["fdy"]),
+        ]
+
+    # row major flattening keeps rows of each individual contiguous
+    columns = {}
+    for key in COLUMNS:
+        aggregate_col = np.hstack([effects[key] for effects in aggregate]).reshape(-1)
+        individual_col = np.hstack([effects[key] for effects in individual]).reshape(-1)
+        columns[key] = np.concatenate((aggregate_col, individual_col))
+    columns["individual"] = columns["individual"].astype(np.int64)
+    for key in CATEGORICAL:
+        columns[key] = columns[key].astype(np.int16)
+
+    nr_rows_indiv = sum(effects["value"].shape[1] for effects in individual)
+    meta = {
+        "categories": {
+            "source": [str(var) for var in list(model_dat["xvars"]) + list(model_dat["yvars"])],
+            "target": [str(var) for var in list(model_dat["xvars"]) + list(model_dat["yvars"])],
+            "effect_type": list(EFFECT_TYPES),
+            },
+        "nr_rows": len(columns["value"]),
+        "offset_indiv": len(columns["value"]) - indiv_dat["mx_indivs"].shape[0] * nr_rows_indiv,
+        "nr_rows_indiv": nr_rows_indiv,
+        "nr_indiv": indiv_dat["mx_indivs"].shape[0],
+        }
+
+    return columns, meta
+
+def export_effects(model_dat, estimate_dat, indiv_dat, path=None):
+    """export effects in long form to path, default dir_path + "effects",
+    as Parquet file path.parquet if export_format in model_dat is "parquet",
+    default if pyarrow is installed, with dictionary encoded categorical columns,
+    or as directory path of one .npy file per column and meta.json if "npy",
+    returns path of export"""
+
+    if path is None:
+        path = model_dat["dir_path"] + "effects"
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        export_format = model_dat.get("export_format", "parquet")
+    except ImportError:
+        export_format = model_dat.get("export_format", "npy")
+        if export_format == "parquet":
+            raise ImportError("export_format 'parquet' requires pyarrow, "
+                              "install pyarrow or use export_format 'npy'.")
+    if export_format not in ("parquet", "npy"):
+        raise ValueError("Unknown export_format {}, use 'parquet' or 'npy'."
+                         .format(export_format))
+
+    columns, meta = effects_long(model_dat, estimate_dat, indiv_dat)
+
+    if export_format == "parquet":
+        path += ".parquet"
+        arrays = []
+        for key in COLUMNS:
+            if key in CATEGORICAL:
+                arrays.append(pyarrow.DictionaryArray.from_arrays(
+                    columns[key], pyarrow.array(meta["categories"][key])))
+            else:
+                arrays.append(pyarrow.array(columns[key]))
+        table = pyarrow.Table.from_arrays(arrays, names=list(COLUMNS))
+        table = table.replace_schema_metadata({"causing": json.dumps(meta)})
+        pyarrow.parquet.write_table(table, path,
+                                    row_group_size=model_dat.get("export_row_group", 2**16))
+    else:
+        os.makedirs(path, exist_ok=True)
+        for key in COLUMNS:
+            np.save(os.path.join(path, key + ".npy"), columns[key])
+        with open(os.path.join(path, "meta.json"), "w") as file:
+            json.dump(meta, file)
+
+    print("\nExported {} effects of {} individuals to {}."
+          .format(meta["nr_rows"], meta["nr_indiv"], path))
+
+    return path
+
+def read_meta(path):
+    """metadata of exported effects: categories, number of rows,
+    offset_indiv and nr_rows_indiv of the rows of individuals"""
+
+    if path.endswith(".parquet"):
+        import pyarrow.parquet
+        metadata = pyarrow.parquet.read_schema(path).metadata
+        return json.loads(metadata[b"causing"])
+
+    with open(os.path.join(path, "meta.json")) as file:
+        return json.load(file)
+
+def read_effects(path, columns=None, rows=None, individuals=None):
+    """read exported effects as DataFrame, only columns given and only row range
+    rows = (start, stop) or rows of individuals = (start, stop),
+    Parquet files read only the overlapping row groups, .npy columns are memory mapped"""
+
+    meta = read_meta(path)
+    if columns is None:
+        columns = COLUMNS
+    if individuals is not None:
+        rows = (meta["offset_indiv"] + individuals[0] * meta["nr_rows_indiv"],
+                meta["offset_indiv"] + individuals[1] * meta["nr_rows_indiv"])
+    start, stop = (0, meta["nr_rows"]) if rows is None else rows
+    stop = min(stop, meta["nr_rows"])
+
+    if path.endswith(".parquet"):
+        import pyarrow.parquet
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        groups = []
+        group_start = 0
+        first_start = None
+        for group in range(parquet_file.num_row_groups):
+            group_stop = group_start + parquet_file.metadata.row_group(group).num_rows
+            if group_start < stop and group_stop > start:
+                groups.append(group)
+                if first_start is None:
+                    first_start = group_start
+            group_start = group_stop
+        if not groups:
+            return DataFrame({key: [] for key in columns})
+        table = parquet_file.read_row_groups(groups, columns=list(columns))
+        table = table.slice(start - first_start, stop - start)
+        return table.to_pandas()
+
+    effects = {}
+    for key in columns:
+        column = np.load(os.path.join(path, key + ".npy"), mmap_mode="r")[start:stop]
+        if key in CATEGORICAL:
+            effects[key] = Categorical.from_codes(column, meta["categories"][key])
+        else:
+            effects[key] = np.array(column)
+
+    return DataFrame(effects)
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
-"""Create direct, total and mediation Graphviz graph from dot_str using pydot."""
+"""Create direct, total and mediation Graphviz graph from dot_str, rendered concurrently."""
+
+from concurrent.futures import ThreadPoolExecutor
 
 from numpy import amax, array_equal, allclose, isnan, logical_and
 from pandas import DataFrame
 
+import svg
 import utils
 
 
@@ -68,10 +71,21 @@ def single_nodes(xnodes, ynodes, mat_id):
 
     return sing_nod
 
+def layout_attrs(layout, key, filename):
+    """position attributes of node or edge (tail, head) key in shared layout"""
+
+    if key not in layout:
+        raise ValueError("{} {} of {} not found in shared Graphviz layout, "
+                         "set shared_layout False to lay out each graph separately."
+                         .format("Edge" if isinstance(key, tuple) else "Node", key, filename))
+
+    return layout[key]
+
 def dot(xnodes, ynodes, weights, id_mat, nodeff,
-        color, base, colortrans, filename, model_dat):
+        color, base, colortrans, filename, model_dat, layout=None):
     """create inner graphviz dot_string,
-    do not show edges with exact zero weight, irrespective of id matrix"""
+    do not show edges with exact zero weight, irrespective of id matrix,
+    with fixed node and edge positions from layout if given"""
 
     xdim = len(xnodes)
     ydim = len(ynodes)
@@ -98,6 +112,8 @@ def dot(xnodes, ynodes, weights, id_mat, nodeff,
                 else:
                     wei_str = utils.roundec(wei)
                 col_str = color_str(wei, base, True, color, colortrans)
+                if layout is not None:
+                    col_str += layout_attrs(layout, (str(xnode), str(ynode)), filename)
                 dot_str += ('         "{}" -> "{}" [label = "{}"{}];\n'
                             .format(xnode, ynode, wei_str, col_str))
 
@@ -123,6 +139,8 @@ def dot(xnodes, ynodes, weights, id_mat, nodeff,
                 xnode_show = rr_report.break_string(xnode_show)
             else:
                 xnode_show = xnode
+            if layout is not None:
+                col_str += layout_attrs(layout, str(xnode), filename)
             dot_str += ('         "{}"[label = "{}\\n{}"{}];\n'
                         .format(xnode, xnode_show, nodeff_str, col_str))
 
@@ -145,8 +163,12 @@ def compute_color_base(datas):
     return base
 
 def create_and_save_graph(xnodes, ynodes, x_weights_idmat_nodeff, y_weights_idmat_nodeff,
-                          color, dir_path, filename, model_dat, colortrans=None):
-    """create graph as dot string, save it as png and return it as svg"""
+                          color, dir_path, filename, model_dat, colortrans=None,
+                          executor=None, layouts=None):
+    """create graph as dot string, save it as png and return it as svg,
+    if executor is given, render concurrently and return future of svg string,
+    if dict layouts is given, graphs of same type, e.g. IDE_0 and IDE_1, share the layout
+    computed once for the first graph, and are only relabeled and recolored"""
 
     form = ("         node [style=rounded]\n"
             "         node [shape=box]\n"
@@ -161,18 +183,56 @@ def create_and_save_graph(xnodes, ynodes, x_weights_idmat_nodeff, y_weights_idma
     else:
         base = abs(color) # e.g. color = 2 for t-values
 
-    x_dot = dot(xnodes, ynodes, *x_weights_idmat_nodeff,
-                color, base, colortrans, filename, model_dat)
-    y_dot = dot(ynodes, ynodes, *y_weights_idmat_nodeff,
-                color, base, colortrans, filename, model_dat)
-    dot_str = "digraph { \n" + form + x_dot + y_dot + "        }"
+    def graph_dot(layout=None):
+        x_dot = dot(xnodes, ynodes, *x_weights_idmat_nodeff,
+                    color, base, colortrans, filename, model_dat, layout)
+        y_dot = dot(ynodes, ynodes, *y_weights_idmat_nodeff,
+                    color, base, colortrans, filename, model_dat, layout)
+        return "digraph { \n" + form + x_dot + y_dot + "        }"
+
+    # on-disk cache of rendered graphs, disabled if graph_cache is None
+    cache = (model_dat.get("graph_cache", dir_path + "graph_cache/"),
+             model_dat.get("graph_cache_size", 100e6))
+
+    # fixed layout per graph type, rendered by neato without layout pass
+    if layouts is None:
+        dot_str = graph_dot()
+        prog = ("dot",)
+    else:
+        graph_type = filename.split("_")[0]
+        if graph_type not in layouts:
+            layouts[graph_type] = utils.graph_layout(graph_dot(), *cache)
+        dot_str = graph_dot(layouts[graph_type])
+        prog = ("neato", "-n2")
 
-    utils.save_graph(dir_path, filename, dot_str)
+    if executor is not None:
+        return executor.submit(utils.render_graph, dot_str, dir_path, filename, *cache, prog)
 
-    graph_svg = utils.render_dot(dot_str, out_type="svg")
+    graph_svg = svg.fromstring(utils.render_graph(dot_str, dir_path, filename, *cache, prog))
 
     return graph_svg
 
+def rendered_svg(graph):
+    """svg string from future of concurrently rendered graph, None if not rendered"""
+
+    if graph is None:
+        return None
+
+    return graph.result()
+
+def drawing(svg_str):
+    """svg graph from svg string, None if not rendered"""
+
+    if svg_str is None:
+        return None
+
+    return svg.fromstring(svg_str)
+
+def rendered(graph):
+    """svg graph from future of concurrently rendered svg string, None if not rendered"""
+
+    return drawing(rendered_svg(graph))
+
 def create_graphs(model_dat, estimate_dat, indiv_dat):
     """creates direct, total and mediation graph,
     for theoretical model and estimated model"""
@@ -184,32 +244,35 @@ def create_graphs(model_dat, estimate_dat, indiv_dat):
     mx_theo, my_theo = utils.directmat_alg(
         model_dat["direct_theo"], model_dat["idx"], model_dat["idy"])
 
+    # Graphviz subprocesses run concurrently, in a bounded thread pool
+    executor = ThreadPoolExecutor(max_workers=model_dat.get("graph_workers"))
+
     print("\nAverage and estimated graphs")
     print("ADE")
     direct_graph = create_and_save_graph(
         xnodes, ynodes,
         (mx_theo, model_dat["idx"], None),
         (my_theo, model_dat["idy"], None),
-        False, dir_path, "ADE", model_dat)
+        False, dir_path, "ADE", model_dat, executor=executor)
     print("AME")
     mediation_graph = create_and_save_graph(
         xnodes, ynodes,
         (model_dat["eyx_theo"], model_dat["fdx"], model_dat["exj_theo"]),
         (model_dat["eyy_theo"], model_dat["fdy"], model_dat["eyj_theo"]),
-        False, dir_path, "AME", model_dat)
+        False, dir_path, "AME", model_dat, executor=executor)
 
     print("EDE")
     direct_hat_graph = create_and_save_graph(
         xnodes, ynodes,
         (estimate_dat["mx_hat"], model_dat["idx"], None),
         (estimate_dat["my_hat"], model_dat["idy"], None),
-        False, dir_path, "EDE", model_dat)
+        False, dir_path, "EDE", model_dat, executor=executor)
     print("EME")
     mediation_hat_graph = create_and_save_graph(
         xnodes, ynodes,
         (estimate_dat["eyx_hat"], model_dat["fdx"], estimate_dat["exj_hat"]),
         (estimate_dat["eyy_hat"], model_dat["fdy"], estimate_dat["eyj_hat"]),
-        False, dir_path, "EME", model_dat)
+        False, dir_path, "EME", model_dat, executor=executor)
 
     print("ED0")
     direct_tval_graph_0 = create_and_save_graph(
@@ -220,7 +283,7 @@ def create_graphs(model_dat, estimate_dat, indiv_dat):
         (utils.tvals(estimate_dat["my_hat"], estimate_dat["my_hat_std"]),
          model_dat["idy"],
          None),
-        2, dir_path, "ED0", model_dat, lambda x : abs(x))
+        2, dir_path, "ED0", model_dat, lambda x : abs(x), executor=executor)
     print("EM0")
     mediation_tval_graph_0 = create_and_save_graph(
         xnodes, ynodes,
@@ -230,7 +293,7 @@ def create_graphs(model_dat, estimate_dat, indiv_dat):
         (utils.tvals(estimate_dat["eyy_hat"], estimate_dat["eyy_hat_std"]),
          model_dat["fdy"],
          utils.tvals(estimate_dat["eyj_hat"], estimate_dat["eyj_hat_std"])),
-        2, dir_path, "EM0", model_dat, lambda x : abs(x))
+        2, dir_path, "EM0", model_dat, lambda x : abs(x), executor=executor)
 
     print("ED1")
     direct_tval_graph_1 = create_and_save_graph(
@@ -243,7 +306,7 @@ def create_graphs(model_dat, estimate_dat, indiv_dat):
           estimate_dat["my_hat_std"])),
          model_dat["idy"],
          None),
-        2, dir_path, "ED1", model_dat, lambda x : -abs(x))
+        2, dir_path, "ED1", model_dat, lambda x : -abs(x), executor=executor)
     print("EM1")
     mediation_tval_graph_1 = create_and_save_graph(
         xnodes, ynodes,
@@ -257,7 +320,7 @@ def create_graphs(model_dat, estimate_dat, indiv_dat):
          model_dat["fdy"],
          (utils.tvals(estimate_dat["eyj_hat"] - model_dat["eyj_theo"],
           estimate_dat["eyj_hat_std"]))),
-        2, dir_path, "EM1", model_dat, lambda x : -abs(x))
+        2, dir_path, "EM1", model_dat, lambda x : -abs(x), executor=executor)
     
     # show total graphs only for smaller ndim
     show_total_ndim = 10 # ToDo: set globally # yyy
@@ -267,13 +330,13 @@ def create_graphs(model_dat, estimate_dat, indiv_dat):
             xnodes, ynodes,
             (model_dat["ex_theo"], model_dat["edx"], None),
             (model_dat["ey_theo"], model_dat["edy"], None),
-            False, dir_path, "ATE", model_dat)
+            False, dir_path, "ATE", model_dat, executor=executor)
         print("ETE")
         total_hat_graph = create_and_save_graph(
             xnodes, ynodes,
             (estimate_dat["ex_hat"], model_dat["edx"], None),
             (estimate_dat["ey_hat"], model_dat["edy"], None),
-            False, dir_path, "ETE", model_dat)
+            False, dir_path, "ETE", model_dat, executor=executor)
         print("ET0")
         total_tval_graph_0 = create_and_save_graph(
             xnodes, ynodes,
@@ -283,7 +346,7 @@ def create_graphs(model_dat, estimate_dat, indiv_dat):
             (utils.tvals(estimate_dat["ey_hat"], estimate_dat["ey_hat_std"]),
              model_dat["edy"],
              None),
-            2, dir_path, "ET0", model_dat, lambda x : abs(x))
+            2, dir_path, "ET0", model_dat, lambda x : abs(x), executor=executor)
         print("ET1")
         total_tval_graph_1 = create_and_save_graph(
             xnodes, ynodes,
@@ -295,14 +358,15 @@ def create_graphs(model_dat, estimate_dat, indiv_dat):
               estimate_dat["ey_hat_std"])),
              model_dat["edy"],
              None),
-            2, dir_path, "ET1", model_dat, lambda x : -abs(x))
+            2, dir_path, "ET1", model_dat, lambda x : -abs(x), executor=executor)
     else:
         total_graph = None
         total_hat_graph = None
         total_tval_graph_0 = None
         total_tval_graph_1 = None
 
-    # mediation graphs
+    # mediation graphs, individual graphs of same type share one layout
+    layouts = {} if model_dat.get("shared_layout", True) else None
     direct_indiv_graphs = []
     total_indiv_graphs = []
     mediation_indiv_graphs = []
@@ -318,14 +382,16 @@ def create_graphs(model_dat, estimate_dat, indiv_dat):
             xnodes, ynodes,
             (indiv_dat["mx_indivs"][i], model_dat["idx"], None),
             (indiv_dat["my_indivs"][i], model_dat["idy"], None),
-            True, dir_path, "IDE" + "_" + str(i), model_dat)
+            True, dir_path, "IDE" + "_" + str(i), model_dat,
+            executor=executor, layouts=layouts)
         direct_indiv_graphs.append(direct_indiv_graph)
         print("IME")
         mediation_indiv_graph = create_and_save_graph(
             xnodes, ynodes,
             (indiv_dat["eyx_indivs"][i], model_dat["fdx"], indiv_dat["exj_indivs"][:, i]),
             (indiv_dat["eyy_indivs"][i], model_dat["fdy"], indiv_dat["eyj_indivs"][:, i]),
-            True, dir_path, "IME" + "_" + str(i), model_dat)
+            True, dir_path, "IME" + "_" + str(i), model_dat,
+            executor=executor, layouts=layouts)
         mediation_indiv_graphs.append(mediation_indiv_graph)
         if model_dat["ndim"] < show_total_ndim:
             print("ITE")
@@ -333,33 +399,39 @@ def create_graphs(model_dat, estimate_dat, indiv_dat):
                 xnodes, ynodes,
                 (indiv_dat["ex_indivs"][i], model_dat["edx"], None),
                 (indiv_dat["ey_indivs"][i], model_dat["edy"], None),
-                True, dir_path, "ITE" + "_" + str(i), model_dat)
+                True, dir_path, "ITE" + "_" + str(i), model_dat,
+                executor=executor, layouts=layouts)
             total_indiv_graphs.append(total_indiv_graph)
         else:
             total_indiv_graphs.append(None)
 
-    # render and return graph_dat
+    # wait for rendering and return graph_dat,
+    # individual graphs as svg strings, converted to drawings only when reported
+    direct_indiv_svgs = [rendered_svg(graph) for graph in direct_indiv_graphs]
+    total_indiv_svgs = [rendered_svg(graph) for graph in total_indiv_graphs]
+    mediation_indiv_svgs = [rendered_svg(graph) for graph in mediation_indiv_graphs]
     graph_dat = {
         # average graphs
-        "direct_graph": direct_graph,
-        "total_graph": total_graph,
-        "mediation_graph": mediation_graph,
+        "direct_graph": rendered(direct_graph),
+        "total_graph": rendered(total_graph),
+        "mediation_graph": rendered(mediation_graph),
         # estimated graphs
-        "direct_hat_graph": direct_hat_graph,
-        "total_hat_graph": total_hat_graph,
-        "mediation_hat_graph": mediation_hat_graph,
+        "direct_hat_graph": rendered(direct_hat_graph),
+        "total_hat_graph": rendered(total_hat_graph),
+        "mediation_hat_graph": rendered(mediation_hat_graph),
         # tvalues graphs wrt 0
-        "direct_tval_graph_0": direct_tval_graph_0,
-        "total_tval_graph_0": total_tval_graph_0,
-        "mediation_tval_graph_0": mediation_tval_graph_0,
+        "direct_tval_graph_0": rendered(direct_tval_graph_0),
+        "total_tval_graph_0": rendered(total_tval_graph_0),
+        "mediation_tval_graph_0": rendered(mediation_tval_graph_0),
         # tvalues graphs wrt 1
-        "direct_tval_graph_1": direct_tval_graph_1,
-        "total_tval_graph_1": total_tval_graph_1,
-        "mediation_tval_graph_1": mediation_tval_graph_1,
+        "direct_tval_graph_1": rendered(direct_tval_graph_1),
+        "total_tval_graph_1": rendered(total_tval_graph_1),
+        "mediation_tval_graph_1": rendered(mediation_tval_graph_1),
         # individual graphs
-        "direct_indiv_graphs": direct_indiv_graphs,
-        "total_indiv_graphs": total_indiv_graphs,
-        "mediation_indiv_graphs": mediation_indiv_graphs,
+        "direct_indiv_svgs": direct_indiv_svgs,
+        "total_indiv_svgs": total_indiv_svgs,
+        "mediation_indiv_svgs": mediation_indiv_svgs,
     }
+    executor.shutdown()
 
     return graph_dat
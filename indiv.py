@@ -66,30 +66,20 @@ def create_indiv(model_dat):
     dx_mat, xdat_based = compute_delta_mat("x", model_dat)
     dy_mat, yhat_based = compute_delta_mat("y", model_dat)
 
-    # compute direct, total and mediation indivs
-    exj_indivs = zeros((model_dat["mdim"], model_dat["tau"]))
-    eyj_indivs = zeros((model_dat["ndim"], model_dat["tau"]))
-    mx_indivs = []                                                          # tau times (ndim, mdim)
-    my_indivs = []                                                          # tau times (mdim, mdim)
-    ex_indivs = []                                                          # tau times (ndim, mdim)
-    ey_indivs = []                                                          # tau times (mdim, mdim)
-    eyx_indivs = []                                                         # tau times (ndim, mdim)
-    eyy_indivs = []                                                         # tau times (mdim, mdim)
-    print()
-    for obs in range(min(model_dat["tau"],
-                         model_dat["show_nr_indiv"])):
-        print("Analyze individual {:5}".format(obs))
-        # compute indivs row wise, using individual effects, using braodcasting for multiplication
-        exj_indivs[:, obs] = model_dat["exj_theos"][obs] * dx_mat[:, obs].T # (mdim)
-        eyj_indivs[:, obs] = model_dat["eyj_theos"][obs] * dy_mat[:, obs].T # (ndim)
-        # compute mediation indivs coulumn wise, using individual eyx_theo, eyy_theos,
-        # note: when multiplying a large indiv to a derivative, linear approx. errors can occur       
-        mx_indivs.append(model_dat["mx_theos"][obs] * dx_mat[:, obs])       # (ndim, mdim)
-        my_indivs.append(model_dat["my_theos"][obs] * dy_mat[:, obs])       # (mdim, mdim)
-        ex_indivs.append(model_dat["ex_theos"][obs] * dx_mat[:, obs])       # (ndim, mdim)
-        ey_indivs.append(model_dat["ey_theos"][obs] * dy_mat[:, obs])       # (mdim, mdim)
-        eyx_indivs.append(model_dat["eyx_theos"][obs] * dx_mat[:, obs])     # (ndim, mdim)
-        eyy_indivs.append(model_dat["eyy_theos"][obs] * dy_mat[:, obs])     # (mdim, mdim)
+    # compute direct, total and mediation indivs for all observations,
+    # using individual effects, using broadcasting for multiplication
+    exj_indivs = model_dat["exj_theos"].T * dx_mat                              # (mdim, tau)
+    eyj_indivs = model_dat["eyj_theos"].T * dy_mat                              # (ndim, tau)
+    # compute mediation indivs coulumn wise, using individual eyx_theo, eyy_theos,
+    # note: when multiplying a large indiv to a derivative, linear approx. errors can occur
+    dx_cols = dx_mat.T.reshape(model_dat["tau"], 1, model_dat["mdim"])
+    dy_cols = dy_mat.T.reshape(model_dat["tau"], 1, model_dat["ndim"])
+    mx_indivs = model_dat["mx_theos"] * dx_cols                                 # (tau, ndim, mdim)
+    my_indivs = model_dat["my_theos"] * dy_cols                                 # (tau, ndim, ndim)
+    ex_indivs = model_dat["ex_theos"] * dx_cols                                 # (tau, ndim, mdim)
+    ey_indivs = model_dat["ey_theos"] * dy_cols                                 # (tau, ndim, ndim)
+    eyx_indivs = model_dat["eyx_theos"] * dx_cols                               # (tau, ndim, mdim)
+    eyy_indivs = model_dat["eyy_theos"] * dy_cols                               # (tau, ndim, ndim)
 
     indiv_dat = {
         "dx_mat": dx_mat,
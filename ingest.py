@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Data ingestion, CSV files converted once to memory mapped binary arrays."""
+
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+def is_fresh(cache_file, sources):
+    """cache file exists and is not older than any of its source files"""
+
+    if not os.path.exists(cache_file):
+        return False
+    cache_mtime = os.path.getmtime(cache_file)
+
+    return all(os.path.getmtime(source) <= cache_mtime for source in sources)
+
+def replace_file(tmp_file, target_file):
+    """atomically move temporary file to target file, with the default mode of new files
+    given by the umask, since temporary files are readable by their owner only"""
+
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_file, 0o666 & ~umask)
+    os.replace(tmp_file, target_file)
+
+def count_rows(csv_file):
+    """number of non-empty lines of csv file"""
+
+    with open(csv_file, "rb") as file:
+        return sum(1 for line in file if line.strip())
+
+def convert_csv(csv_file, npy_file, delimiter=",", transpose=True, chunk_rows=1000000):
+    """convert csv file in chunks of rows to npy file, without holding all text in memory,
+    if transpose, csv rows are observations and are stored in columns,
+    such that each variable is contiguous, written atomically"""
+
+    nrows = count_rows(csv_file)
+    with open(csv_file) as file:
+        ncols = len(file.readline().split(delimiter))
+    shape = (ncols, nrows) if transpose else (nrows, ncols)
+
+    fd, tmp_file = tempfile.mkstemp(suffix=".npy", dir=os.path.dirname(npy_file) or ".")
+    os.close(fd)
+    try:
+        out = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=np.float64, shape=shape)
+        start = 0
+        for chunk in pd.read_csv(csv_file, sep=delimiter, header=None, dtype=np.float64,
+                                 float_precision="round_trip", chunksize=chunk_rows):
+            stop = start + len(chunk)
+            if transpose:
+                out[:, start:stop] = chunk.values.T
+            else:
+                out[start:stop] = chunk.values
+            start = stop
+        if start != nrows:
+            raise ValueError("Read {} rows of {}, expected {}.".format(start, csv_file, nrows))
+        out.flush()
+        del out
+        replace_file(tmp_file, npy_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+def load_csv(csv_file, delimiter=",", transpose=True, cache_file=None):
+    """data of csv file as read-only memory mapped array,
+    converted to npy cache_file, default csv_file with .npy suffix,
+    only if the cache is missing or older than the csv file,
+    if transpose, csv rows are observations, returned in columns"""
+
+    if cache_file is None:
+        cache_file = os.path.splitext(csv_file)[0] + ".npy"
+    if not is_fresh(cache_file, [csv_file]):
+        convert_csv(csv_file, cache_file, delimiter, transpose)
+
+    # plain ndarray view, operations do not return memmaps
+    return np.asarray(np.load(cache_file, mmap_mode="r"))
+
+def load_derived(cache_file, derive, sources):
+    """array computed by derive() as read-only memory mapped array,
+    stored in npy cache_file, recomputed only if the cache is missing
+    or older than any of the source files, e.g. data and model files"""
+
+    if not is_fresh(cache_file, sources):
+        data = np.ascontiguousarray(derive(), dtype=np.float64)
+        fd, tmp_file = tempfile.mkstemp(suffix=".npy", dir=os.path.dirname(cache_file) or ".")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                np.save(file, data)
+            replace_file(tmp_file, cache_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+
+    return np.asarray(np.load(cache_file, mmap_mode="r"))
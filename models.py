@@ -51,9 +51,9 @@ def example():
 
     # load data
 # =============================================================================
-#     from numpy import loadtxt
-#     xdat = loadtxt("data/xdat.csv", delimiter=",").reshape(len(model_dat["xvars"]), -1)
-#     ymdat = loadtxt("data/ymdat.csv", delimiter=",").reshape(len(model_dat["ymvars"]), -1)
+#     import ingest
+#     xdat = ingest.load_csv("data/xdat.csv", transpose=False)
+#     ymdat = ingest.load_csv("data/ymdat.csv", transpose=False)
 # =============================================================================
 
     model_dat["xdat"] = xdat                    # exogenous data
@@ -202,18 +202,23 @@ def education():
         "dir_path": "output/",
         }
 
-    # load and transform data
-    from numpy import array, concatenate, exp, loadtxt
-    xymdat = loadtxt("data/education.csv", delimiter=",").reshape(-1, 10)
-    xymdat = xymdat.T               # observations in columns
-    #xymdat = xymdat[:, 0:200]      # just some of the 17,919 observations
-    xdat = xymdat[[7, 6, 9, 8, 5]]  # without PERSONID, TIMETRND
-    age = array(xymdat[3, :] + xymdat[1, :] + 5).reshape(1, -1) # age = POTEXPER + EDUC + 5
-    ymdat = xymdat[[1, 3, 2]]
-    ymdat[2,:] = exp(ymdat[2,:])    # wage instead of log wage
-    xdat = concatenate((xdat, age))
-    
-    model_dat["xdat"] = xdat
-    model_dat["ymdat"] = ymdat
+    # load and transform data, cached as memory mapped binary arrays
+    import ingest
+    from numpy import exp, vstack
+
+    def derive_xymdat():
+        xymdat = ingest.load_csv("data/education.csv")     # observations in columns
+        #xymdat = xymdat[:, 0:200]      # just some of the 17,919 observations
+        xdat = xymdat[[7, 6, 9, 8, 5]]  # without PERSONID, TIMETRND
+        age = xymdat[3, :] + xymdat[1, :] + 5   # age = POTEXPER + EDUC + 5
+        ymdat = xymdat[[1, 3, 2]]
+        ymdat[2,:] = exp(ymdat[2,:])    # wage instead of log wage
+        return vstack((xdat, age, ymdat))
+
+    xymdat = ingest.load_derived("data/education_xymdat.npy", derive_xymdat,
+                                 ["data/education.csv", __file__])
+
+    model_dat["xdat"] = xymdat[:6]      # views, without copying
+    model_dat["ymdat"] = xymdat[6:]
 
     return model_dat
@@ -5,6 +5,7 @@
 # spyder cannot read good-names from .pylintrc
 
 from copy import copy, deepcopy
+from time import time
 
 from numpy import array, empty, median, zeros
 from reportlab.lib import colors
@@ -14,6 +15,7 @@ from reportlab.lib.units import cm
 from reportlab.platypus import PageBreak, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
 from reportlab.platypus.flowables import KeepTogether
 
+import graph
 import utils
 
 # reportlab setting
@@ -161,7 +163,7 @@ def tvalues_and_biases(analyze_dat):
     doc.build(story, onFirstPage=my_first_page, onLaterPages=my_later_pages)
 
 def mediation_effects(analyze_dat, individual_id):
-    """mediation effects"""
+    """mediation effects, individual graphs converted from their svg strings"""
     
     filename = ("Causing_Individual_Effects_" + str(individual_id) + ".pdf")
     print("Generating PDF report:", filename)
@@ -180,15 +182,15 @@ def mediation_effects(analyze_dat, individual_id):
     story = []
 
     story = story_effect('Individual Direct Effects (IDE)',
-                         analyze_dat["graph_dat"]["direct_indiv_graphs"][individual_id],
+                         graph.drawing(analyze_dat["graph_dat"]["direct_indiv_svgs"][individual_id]),
                          text_individual, story)
     story.append(PageBreak())
     story = story_effect('Individual Total Effects (ITE)',
-                         analyze_dat["graph_dat"]["total_indiv_graphs"][individual_id],
+                         graph.drawing(analyze_dat["graph_dat"]["total_indiv_svgs"][individual_id]),
                          text_individual, story)
     story.append(PageBreak())
     story = story_effect('Individual Mediation Effects (IME)',
-                         analyze_dat["graph_dat"]["mediation_indiv_graphs"][individual_id],
+                         graph.drawing(analyze_dat["graph_dat"]["mediation_indiv_svgs"][individual_id]),
                          text_individual + text_mediation, story)
     # IME table
     table, _ = table_indiv(analyze_dat, individual_id)
@@ -199,6 +201,57 @@ def mediation_effects(analyze_dat, individual_id):
     doc = SimpleDocTemplate(analyze_dat["model_dat"]["dir_path"] + filename)
     doc.build(story, onFirstPage=my_first_page, onLaterPages=my_later_pages)
 
+def report_dat_indiv(analyze_dat):
+    """picklable data for individual reports in worker processes,
+    without graphs, which are sent as svg strings per individual"""
+
+    model_keys = ("dir_path", "final_var", "base_var", "mdim", "ndim", "xvars", "yvars")
+    indiv_keys = ("exj_indivs", "eyj_indivs", "xdat_based", "yhat_based")
+    report_dat = {
+        "model_dat": {key: analyze_dat["model_dat"][key] for key in model_keys
+                      if key in analyze_dat["model_dat"]},
+        "indiv_dat": {key: analyze_dat["indiv_dat"][key] for key in indiv_keys},
+        }
+
+    return report_dat
+
+def mediation_effects_svgs(report_dat, individual_ids, svg_strs):
+    """mediation effects reports for individuals in a worker process,
+    given their (direct, total, mediation) svg strings"""
+
+    keys = ("direct_indiv_svgs", "total_indiv_svgs", "mediation_indiv_svgs")
+    for individual_id, svg_strs_indiv in zip(individual_ids, svg_strs):
+        graph_dat = {key: {individual_id: svg_str}
+                     for key, svg_str in zip(keys, svg_strs_indiv)}
+        mediation_effects(dict(report_dat, graph_dat=graph_dat), individual_id)
+
+def individual_effects(analyze_dat):
+    """mediation effects reports for all individuals with graphs,
+    in nr_workers parallel worker processes if nr_workers > 1 in model_dat"""
+
+    model_dat = analyze_dat["model_dat"]
+    graph_dat = analyze_dat["graph_dat"]
+    nr_indiv = len(graph_dat["direct_indiv_svgs"])
+    nr_workers = min(model_dat.get("nr_workers", 1), nr_indiv)
+
+    start = time()
+    if nr_workers <= 1:
+        for individual_id in range(nr_indiv):
+            mediation_effects(analyze_dat, individual_id)
+    else:
+        # one chunk of individuals per worker, such that report_dat is sent only once each
+        report_dat = report_dat_indiv(analyze_dat)
+        svg_strs = list(zip(graph_dat["direct_indiv_svgs"], graph_dat["total_indiv_svgs"],
+                            graph_dat["mediation_indiv_svgs"]))
+        chunks = [list(range(worker, nr_indiv, nr_workers)) for worker in range(nr_workers)]
+        utils.map_parallel(mediation_effects_svgs,
+                           [(report_dat, chunk, [svg_strs[i] for i in chunk]) for chunk in chunks],
+                           model_dat)
+    seconds = time() - start
+
+    print("\n{} individual reports in {:.2f} s, {:.1f} individuals per second."
+          .format(nr_indiv, seconds, nr_indiv / max(seconds, 1e-9)))
+
 def create_table(data, align, fontcolor, backcolor, box, together=True):
     """create table for data as nested list of table rows"""
 
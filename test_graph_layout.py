@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Tests of parsing shared Graphviz layouts from canned dot -Tdot output."""
+
+import pytest
+
+import graph
+import utils
+
+DOT_STR = "digraph { X1 -> Y1; X1 -> Y2; Y1 -> Y2; }"
+
+# dot -Tdot output with unquoted negative labels, multi-line attribute lists
+# and long lines continued by backslash newline
+DOT_OUTPUT = b'''digraph {
+	graph [bb="0,0,152.69,180"];
+	node [label="\\N"];
+	X1	[height=0.5,
+		label="X1\\n1.2",
+		pos="27,162",
+		width=0.75];
+	Y1	[height=0.5,
+		pos="27,90",
+		width=0.75];
+	X1 -> Y1	[color="#ff0000",
+		label=-0.5,
+		lp="38.5,126",
+		pos="e,27,108.1 27,143.7 27,135.98 27,126.71 27,118.11"];
+	X1 -> Y2	[label=-.25, lp="70,126", pos="e,80,10 90,20"];
+	Y1 -> Y2	[label=3,
+		lp="50,54",
+		pos="e,60,35.1 40,70.2 45.5,60.1 \\
+50.3,50.2 55.2,44.1"];
+	Y2	[height=0.5,
+		pos="70,18",
+		width=0.75];
+}
+'''
+
+
+def canned_layout(tmp_path):
+    """layout of DOT_STR parsed from canned dot output in layout cache"""
+
+    cache_dir = str(tmp_path)
+    with open(utils.graph_cache_file(cache_dir, DOT_STR, "dot"), "wb") as file:
+        file.write(DOT_OUTPUT)
+
+    return utils.graph_layout(DOT_STR, cache_dir)
+
+def test_negative_labels_and_multiline_attributes(tmp_path):
+    layout = canned_layout(tmp_path)
+
+    assert layout["X1"] == ', pos = "27,162"'
+    assert layout["Y2"] == ', pos = "70,18"'
+    assert layout[("X1", "Y1")] == (', lp = "38.5,126", '
+                                    'pos = "e,27,108.1 27,143.7 27,135.98 27,126.71 27,118.11"')
+    assert layout[("X1", "Y2")] == ', lp = "70,126", pos = "e,80,10 90,20"'
+    assert layout[("Y1", "Y2")] == (', lp = "50,54", '
+                                    'pos = "e,60,35.1 40,70.2 45.5,60.1 50.3,50.2 55.2,44.1"')
+
+def test_missing_layout_entry(tmp_path):
+    layout = canned_layout(tmp_path)
+
+    assert graph.layout_attrs(layout, ("X1", "Y1"), "IDE_1") == layout[("X1", "Y1")]
+    with pytest.raises(ValueError, match="Edge"):
+        graph.layout_attrs(layout, ("X2", "Y1"), "IDE_1")
+    with pytest.raises(ValueError, match="Node"):
+        graph.layout_attrs(layout, "X2", "IDE_1")
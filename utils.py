@@ -4,106 +4,308 @@
 # pylint: disable=invalid-name # spyder cannot read good-names from .pylintrc
 # pylint: disable=E1101 # "torch has nor 'DoubleTensor' menber"
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from copy import copy, deepcopy
+import hashlib
+import os
 
-import pydot
+import re
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 import numpy as np
 from numpy.random import multivariate_normal, seed
 from numpy import (
-    allclose, array, concatenate, count_nonzero, diag, eye, empty,
-    fill_diagonal, hstack, isnan, kron, median, nan, ones, reshape, std, tile,
-    var, vstack, zeros)
+    allclose, array, concatenate, count_nonzero, diag, eye,
+    hstack, isnan, kron, median, nan, ones, reshape, std, tile, var, vstack,
+    zeros)
 import numdifftools as nd
 from numpy.linalg import cholesky, inv, norm
 from pandas import DataFrame
+from scipy.linalg import solve_triangular
 from scipy.optimize import minimize
-from sympy import diff, Heaviside, lambdify
+from scipy.sparse import csc_matrix, identity, issparse
+from scipy.sparse.linalg import spsolve, splu
+from sympy import diff, Dummy, lambdify, S
+from sympy.printing.pycode import NumPyPrinter
 import torch
 
-import svg
-
 # set numpy random seed
 seed(1002)
 
 
-def adjacency(model_dat):
-    """numeric function for model and direct effects, identification matrics"""
+class ModelPrinter(NumPyPrinter):
+    """numpy code printer for evaluating sympy expressions over all observations,
+    sympy Max and Min are printed elementwise instead of numpy amax, amin reductions,
+    Heaviside arising from derivatives of Max and Min is printed as numpy heaviside,
+    DiracDelta arising from second derivatives is printed as zero"""
 
-    define_equations = model_dat["define_equations"]
-    xvars = model_dat["xvars"]
-    yvars = model_dat["yvars"]
+    def _print_elementwise(self, func, args):
+        if len(args) == 1:
+            return self._print(args[0])
+        return "{}({}, {})".format(self._module_format(func),
+                                   self._print(args[0]),
+                                   self._print_elementwise(func, args[1:]))
+
+    def _print_Max(self, expr):
+        return self._print_elementwise("numpy.maximum", expr.args)
+
+    def _print_Min(self, expr):
+        return self._print_elementwise("numpy.minimum", expr.args)
+
+    def _print_Heaviside(self, expr):
+        """Heaviside(x) = 0 if x < 0 and 1 if x > 0, but
+        Heaviside(0) needs to be defined by user,
+        we set Heaviside(0) to 0 because in general there is no sensititvity,
+        unless it is given as second argument Heaviside(x, H0)"""
+
+        h0 = expr.args[1] if len(expr.args) > 1 else 0
+        return "{}({}, {})".format(self._module_format("numpy.heaviside"),
+                                   self._print(expr.args[0]),
+                                   self._print(h0))
+
+    def _print_DiracDelta(self, expr):
+        """DiracDelta arising from second derivatives of Max and Min
+        is zero almost everywhere"""
+
+        return "0"
+
+def lambdify_vec(args, expr):
+    """lambdify sympy expression using numpy, vectorized over observations"""
+
+    # numpy names first, sympy names only for functions unknown to numpy
+    modules = ['numpy', 'sympy']
+    printer = ModelPrinter({'fully_qualified_modules': False, 'inline': True,
+                            'allow_unknown_functions': True})
+
+    return lambdify(args, expr, modules=modules, printer=printer)
+
+def broadcast_obs(values, tau):
+    """stack values of lambdified expressions to array (len(values), tau),
+    constant expressions give scalars which are broadcasted over observations"""
+
+    return array([np.broadcast_to(value, (tau,)) for value in values])
+
+def map_parallel(func, args_list, model_dat):
+    """apply func to each tuple of args in args_list, returning results in order
+
+    in parallel if nr_workers > 1 in model_dat,
+    using a process pool (default) or a thread pool given by pool in model_dat,
+    for a process pool, func must be defined on module level and args must be picklable"""
+
+    nr_workers = model_dat.get("nr_workers", 1)
+    pool = model_dat.get("pool", "process")
+    executors = {"process": ProcessPoolExecutor, "thread": ThreadPoolExecutor}
+    if pool not in executors:
+        raise ValueError("Unknown pool {}, use 'process' or 'thread'.".format(pool))
+
+    if nr_workers <= 1 or len(args_list) <= 1:
+        return [func(*args) for args in args_list]
+    with executors[pool](max_workers=min(nr_workers, len(args_list))) as executor:
+        return list(executor.map(func, *zip(*args_list)))
+
+def evaluate_chunked(func, xvals, model_dat, *args):
+    """evaluate func(xvals, *args) for observations, i.e. columns of xvals,
+    in chunks of chunk_size observations in model_dat (default 100000),
+    written into preallocated output arrays of shape (nr_rows, tau),
+    func returns a single array or a tuple of arrays
+
+    chunks bound the memory of temporaries, they are evaluated serially"""
+
+    tau = xvals.shape[1]
+    chunk_size = int(model_dat.get("chunk_size", 100000))
+    starts = range(0, tau, chunk_size)
+
+    first = func(xvals[:, :chunk_size], *args)
+    single = not isinstance(first, tuple)
+    outs = tuple(np.empty((part.shape[0], tau)) for part in ((first,) if single else first))
+
+    def evaluate(start, parts=None):
+        if parts is None:
+            parts = func(xvals[:, start:start + chunk_size], *args)
+        for out, part in zip(outs, (parts,) if single else parts):
+            out[:, start:start + chunk_size] = part
+
+    evaluate(0, first)
+    del first
+    for start in starts[1:]:
+        evaluate(start)
+
+    return outs[0] if single else outs
+
+def picklable(model_dat, obs=True):
+    """shallow copy of model_dat without compiled model functions,
+    to be passed to worker processes
+
+    if obs is False, also without observation-wise data,
+    e.g. for estimation from data moments"""
+
+    obs_keys = ("xdat", "ymdat", "xcdat", "ymcdat", "yhat",
+                "mx_theos", "my_theos", "ex_theos", "ey_theos",
+                "exj_theos", "eyx_theos", "eyj_theos", "eyy_theos")
+
+    return {key: value for key, value in model_dat.items()
+            if not callable(value) and (obs or key not in obs_keys)}
+
+def equations_alg(equations, yvars, bias=0, bias_ind=0):
+    """algebraic equations plus bias containing xvars by substituting yvars"""
+
+    ndim = len(yvars)
+
+    equationsx = list(equations)
+    equationsx[bias_ind] = bias + equationsx[bias_ind]
+    for i in range(ndim):
+        for j in range(i + 1, ndim):
+            if hasattr(equationsx[j], 'subs'):
+                equationsx[j] = equationsx[j].subs(yvars[i], equationsx[i])
+
+    return equationsx
+
+def compile_model(equations, xvars, yvars, bias_ind=0):
+    """numeric model plus bias in terms of xvars,
+    compiled once per bias_ind with the bias as numeric argument"""
+
+    bias = Dummy("bias")
+    equationsx = equations_alg(equations, yvars, bias, bias_ind)
+    model_lam = lambdify_vec((xvars, bias), equationsx)
+
+    return model_lam, equationsx, bias
+
+def compile_bias_derivs(equations, xvars, yvars, bias_ind=0):
+    """numeric model plus bias in terms of xvars stacked with its first and
+    second derivatives wrt. the bias, compiled with the bias as numeric argument"""
+
+    bias = Dummy("bias")
+    equationsx = equations_alg(equations, yvars, bias, bias_ind)
+    dequationsx = [diff(eq, bias) for eq in equationsx]
+    d2equationsx = [diff(deq, bias) for deq in dequationsx]
+    derivs_lam = lambdify_vec((xvars, bias), equationsx + dequationsx + d2equationsx)
+
+    return derivs_lam
+
+def numeric_bias_derivs(equations, xvars, yvars):
+    """numeric function for model plus bias and its derivatives wrt. the bias,
+    compiling once per bias_ind when first evaluated"""
 
     ndim = len(yvars)
     mdim = len(xvars)
 
-    def equations_alg(xvars, bias=0, bias_ind=0):
-        """algebraic equations plus bias containing xvars by substituting yvars"""
+    # compiled derivatives, one per bias_ind
+    derivs_lams = {}
 
-        equationsx = list(define_equations(*xvars))
-        equationsx[bias_ind] = bias + equationsx[bias_ind]
-        for bias_ind in range(ndim):
-            for j in range(bias_ind + 1, ndim):
-                if hasattr(equationsx[j], 'subs'):
-                    equationsx[j] = equationsx[j].subs(yvars[bias_ind], equationsx[bias_ind])
+    def bias_derivs(xvals, bias, bias_ind):
+        """numeric model plus bias yhat, dyhat / dbias and d2yhat / dbias2
+        for all observations, i.e. columns of xvals, each of shape (ndim, tau)"""
 
-        return equationsx
+        if bias_ind not in derivs_lams:
+            derivs_lams[bias_ind] = compile_bias_derivs(equations, xvars, yvars, bias_ind)
 
-    # algebraic equations containing xvars and yvars
-    equations = define_equations(*xvars)
-    
-    # ToDo modules do not work, therefore replace_heaviside required # yyy
-    #modules = [{'Heaviside': lambda x: np.heaviside(x, 0)}, 'sympy', 'numpy']
-    #modules = [{'Heaviside': lambda x: 1 if x > 0 else 0}, 'sympy', 'numpy']
-    modules = ['sympy', 'numpy']
+        xvals = array(xvals, dtype=np.float64).reshape(mdim, -1)
+        derivs = broadcast_obs(derivs_lams[bias_ind](xvals, float(bias)), xvals.shape[1])
+        derivs = derivs.astype(np.float64)
+
+        return derivs[:ndim], derivs[ndim:2 * ndim], derivs[2 * ndim:]
+
+    return bias_derivs
+
+def numeric_model(equations, xvars, yvars):
+    """numeric model function from algebraic equations,
+    compiling the model once per bias_ind when first evaluated"""
+
+    mdim = len(xvars)
+
+    # compiled models, one per bias_ind
+    model_lams = {}
 
     def model(xvals, bias=0, bias_ind=0):
-        """numeric model plus bias in terms of xvars"""
+        """numeric model plus bias in terms of xvars,
+        evaluated for all observations, i.e. columns of xvals, at once"""
+
+        if bias_ind not in model_lams:
+            model_lams[bias_ind] = compile_model(equations, xvars, yvars, bias_ind)
+        model_lam, equationsx, bias_sym = model_lams[bias_ind]
 
         # float for conversion of numpy array from scipy minimize
-        equationsx = equations_alg(xvars, float(bias), bias_ind)
-        model_lam = lambdify(xvars, equationsx, modules=modules)
-        xvals = array(xvals).reshape(mdim, -1)        
+        bias = float(bias)
+        xvals = array(xvals, dtype=np.float64).reshape(mdim, -1)
         try:
-            yhat = array([model_lam(*xval) for xval in xvals.T]).T
+            yhat = broadcast_obs(model_lam(xvals, bias), xvals.shape[1])
         except Exception as e:
             # find warnings
             print(e, "\nFinding erroneous element yhat_it ...")
             for t, xval in enumerate(xvals.T):
                 for i, eq in enumerate(equationsx):
-                    yhat_it = eq.subs(dict(zip(xvars, xval)))
+                    yhat_it = eq.subs(dict(zip(xvars, xval))).subs(bias_sym, bias)
                     print(DataFrame(xval, xvars, [t]))
                     print("i = {}, t = {}, yhat_it = {} {}"
                           .format(i, t, yhat_it, type(yhat_it)))
                     print(yvars[i], "=", eq)
             raise ValueError(e)
-        
+
         return yhat.astype(np.float64)
 
-    # algebraic direct effects containing xvars and yvars
-    mx_alg = array([[diff(eq, xvar) for xvar in xvars] for eq in equations])
-    my_alg = array([[diff(eq, yvar) for yvar in yvars] for eq in equations])
+    return model
+
+def adjacency(model_dat):
+    """numeric function for model and direct effects, identification matrics"""
+
+    define_equations = model_dat["define_equations"]
+    xvars = model_dat["xvars"]
+    yvars = model_dat["yvars"]
+
+    ndim = len(yvars)
+    mdim = len(xvars)
 
-    # algebraic direct effects as lamba function of xvars, yvars
-    #   and then only as function of xvars
-    mx_lamxy = lambdify((xvars, yvars), mx_alg, modules=modules)
-    my_lamxy = lambdify((xvars, yvars), my_alg, modules=modules)
-    def mx_lam(xvars):
-        return mx_lamxy(xvars, equations_alg(xvars))
-    def my_lam(xvars):
-        return my_lamxy(xvars, equations_alg(xvars))
+    # algebraic equations containing xvars and yvars
+    equations = define_equations(*xvars)
+
+    model = numeric_model(equations, xvars, yvars)
+
+    # algebraic direct effects containing xvars and yvars,
+    #   differentiating only wrt. variables occurring in the equation
+    free = [getattr(eq, "free_symbols", set()) for eq in equations]
+    mx_alg = array([[diff(eq, xvar) if xvar in free_eq else S.Zero for xvar in xvars]
+                    for eq, free_eq in zip(equations, free)])
+    my_alg = array([[diff(eq, yvar) if yvar in free_eq else S.Zero for yvar in yvars]
+                    for eq, free_eq in zip(equations, free)])
 
     # identification matrics for direct effects
     idx = digital(mx_alg)
     idy = digital(my_alg)
 
+    # algebraic nonzero direct effects as lamba function of xvars, yvars,
+    #   vectorized over observations
+    mx_lamxy = lambdify_vec((xvars, yvars), list(mx_alg[idx != 0]))
+    my_lamxy = lambdify_vec((xvars, yvars), list(my_alg[idy != 0]))
+
+    def direct_effects(xvals, yvals=None):
+        """numeric direct effects for all observations, i.e. columns of xvals,
+        returns mx (tau, ndim, mdim) and my (tau, ndim, ndim)"""
+
+        xvals = array(xvals, dtype=np.float64).reshape(mdim, -1)
+        tau = xvals.shape[1]
+
+        if yvals is None:
+            yvals = model(xvals)
+        yvals = array(yvals, dtype=np.float64).reshape(ndim, -1)
+        mx = zeros((tau, ndim, mdim))
+        my = zeros((tau, ndim, ndim))
+        mx[:, idx != 0] = broadcast_obs(mx_lamxy(xvals, yvals), tau).T
+        my[:, idy != 0] = broadcast_obs(my_lamxy(xvals, yvals), tau).T
+
+        return mx, my
+
     adjacency_dat = {
+        "equations": equations,
         "model": model,
+        "bias_derivs": numeric_bias_derivs(equations, xvars, yvars),
         "mx_alg": mx_alg,
         "my_alg": my_alg,
-        "mx_lam": mx_lam,
-        "my_lam": my_lam,
+        "direct_effects": direct_effects,
         "idx": idx,
         "idy": idy,
         }
@@ -141,7 +343,7 @@ def simulate(model_dat):
 
     # ymdat from yhat with enndogenous errors
     model = adjacency(model_dat)["model"] # model constructed from adjacency
-    yhat = model(xdat)
+    yhat = evaluate_chunked(model, xdat, model_dat)
     ymdat = fym @ (yhat + multivariate_normal(zeros(ndim), sigmau_theo, model_dat["tau"]).T)
 
     # delete nan columns
@@ -161,31 +363,6 @@ def simulate(model_dat):
 
     return xdat, ymdat
 
-def replace_heaviside(mxy, xvars, xval):
-    """deal with sympy Min and Max giving Heaviside:
-    Heaviside(x) = 0 if x < 0 and 1 if x > 0, but
-    Heaviside(0) needs to be defined by user,
-    we set Heaviside(0) to 0 because in general there is no sensititvity,
-    the numpy heaviside function is lowercase and wants two arguments:
-    an x value, and an x2 to decide what should happen for x==0
-    https://stackoverflow.com/questions/60171926/sympy-name-heaviside-not-defined-within-lambdifygenerated
-    """
-    
-    for i in range(mxy.shape[0]):
-        for j in range(mxy.shape[1]):
-            if hasattr(mxy[i, j], 'subs'):
-                # ToDo: rename, check # yyyy
-                # just for german_insurance substitute xvars again since
-                # mxy still has sympy xvars reintroduced via yvars_elim
-                mxy[i, j] = mxy[i, j].subs(dict(zip(xvars, xval)))
-                
-                #if mxy[i, j] != mxy[i, j].subs(Heaviside(0), 0):
-                #    print("replaced {} by {} in element {} {}"
-                #          .format(mxy[i, j], mxy[i, j].subs(Heaviside(0), 0), i, j))
-                mxy[i, j] = mxy[i, j].subs(Heaviside(0), 0)
-
-    return mxy.astype(np.float64)
-
 def create_model(model_dat):
     """specify model and compute effects"""
 
@@ -207,8 +384,14 @@ def create_model(model_dat):
     # numeric function for model and direct effects, identification matrics
     model_dat.update(adjacency(model_dat))
 
+    # yvars in topological order, checked once for triangular solves,
+    # by default only for larger models, below general inverses are faster
+    triangular_min_ndim = 50 # ToDo: define globally
+    model_dat["triangular"] = (model_dat.get("triangular", ndim >= triangular_min_ndim)
+                               and is_triangular(model_dat["idy"]))
+
     # yhat without enndogenous errors
-    yhat = model_dat["model"](model_dat["xdat"])
+    yhat = evaluate_chunked(model_dat["model"], model_dat["xdat"], model_dat)
     yhat = vstack(yhat).reshape(len(model_dat["yvars"]), -1)
 
     # means and demeaning data for estimation of linear total derivative
@@ -222,7 +405,7 @@ def create_model(model_dat):
     ymcdat = model_dat["ymdat"] - ymmean.reshape(pdim, 1)
 
     # effect identification matrices
-    edx, edy = compute_ed(model_dat["idx"], model_dat["idy"])
+    edx, edy = compute_ed(model_dat["idx"], model_dat["idy"], model_dat.get("sparse", False))
     _, _, fdx, fdy = compute_fd(model_dat["idx"], model_dat["idy"],
                                 model_dat["yvars"], model_dat["final_var"])
 
@@ -237,39 +420,21 @@ def create_model(model_dat):
           "{} direct effects and {} observations."
           .format(ndim, mdim, qdim, tau))
     
-    # individual theoretical effects
-    (mx_theos, my_theos, ex_theos, ey_theos, exj_theos, eyx_theos, eyj_theos, eyy_theos
-     ) = ([] for i in range(8))
-    for obs in range(min(tau,
-                         model_dat["show_nr_indiv"])):
-        xval = model_dat["xdat"][:, obs]
-
-        # numeric direct effects since no sympy algebraic derivative
-        mx_theo = replace_heaviside(array(model_dat["mx_lam"](xval)), model_dat["xvars"], xval) # yyy
-        my_theo = replace_heaviside(array(model_dat["my_lam"](xval)), model_dat["xvars"], xval) # yyy
-
-        # total and final effects
-        ex_theo, ey_theo = total_effects_alg(mx_theo, my_theo, edx, edy)
-        exj_theo, eyj_theo, eyx_theo, eyy_theo = compute_mediation_effects(
-            mx_theo, my_theo, ex_theo, ey_theo, model_dat["yvars"], model_dat["final_var"])
-
-        # append
-        mx_theos.append(mx_theo)
-        my_theos.append(my_theo)
-        ex_theos.append(ex_theo)
-        ey_theos.append(ey_theo)
-        exj_theos.append(exj_theo)
-        eyx_theos.append(eyx_theo)
-        eyj_theos.append(eyj_theo)
-        eyy_theos.append(eyy_theo)
+    # individual theoretical effects for all observations,
+    # batched over observations (tau, ndim, mdim) and (tau, ndim, ndim)
+    mx_theos, my_theos = model_dat["direct_effects"](model_dat["xdat"], yhat)
+    ex_theos, ey_theos = total_effects_alg(mx_theos, my_theos, edx, edy,
+                                           model_dat["triangular"])
+    exj_theos, eyj_theos, eyx_theos, eyy_theos = compute_mediation_effects(
+        mx_theos, my_theos, ex_theos, ey_theos, model_dat["yvars"], model_dat["final_var"])
 
     # theoretical total effects at xmean and corresponding consistent ydet,
     # using closed form algebraic formula from sympy direct effects
     #   instead of automatic differentiation of model
-    mx_theo = replace_heaviside(array(model_dat["mx_lam"](xmean)), model_dat["xvars"], xmean) # yyy
-    my_theo = replace_heaviside(array(model_dat["my_lam"](xmean)), model_dat["xvars"], xmean) # yyy
-    
-    ex_theo, ey_theo = total_effects_alg(mx_theo, my_theo, edx, edy)
+    mx_theo, my_theo = (effects[0] for effects in model_dat["direct_effects"](xmean, ydet))
+
+    ex_theo, ey_theo = total_effects(mx_theo, my_theo, edx, edy, model_dat.get("sparse", False),
+                                     model_dat["triangular"])
     exj_theo, eyj_theo, eyx_theo, eyy_theo = compute_mediation_effects(
         mx_theo, my_theo, ex_theo, ey_theo, model_dat["yvars"], model_dat["final_var"])
     direct_theo = directvec_alg(mx_theo, my_theo, model_dat["idx"], model_dat["idy"])
@@ -290,6 +455,7 @@ def create_model(model_dat):
         "tau": tau,
         "xcdat": xcdat,
         "ymcdat": ymcdat,
+        "moments": compute_moments(xcdat, ymcdat),
         "yhat": yhat,
         "xmean": xmean,
         "mx_theo": mx_theo,
@@ -346,23 +512,20 @@ def submatrix(mat, j):
 
     ndim = mat.shape[0]
     mdim = mat.shape[1]
-    sub = deepcopy(mat)
-
-    mzeros = zeros(mdim)
-    nzeros = zeros(ndim)
+    sub = array(mat, copy=True)
 
     if ndim > 1:
-        sub[j, :] = mzeros
+        sub[j, :] = 0
     if mdim > 1:
-        sub[:, j] = nzeros
+        sub[:, j] = 0
 
     return sub
 
-def compute_ed(idx, idy):
+def compute_ed(idx, idy, sparse=False):
     """compute total effects identification matrices
     from direct identification matrices or direct effects"""
 
-    edx, edy = total_effects_alg(idx, idy, None, None)
+    edx, edy = total_effects(idx, idy, None, None, sparse)
 
     edx = digital(edx)
     edy = digital(edy)
@@ -383,49 +546,182 @@ def compute_fd(idx, idy, yvars, final_var):
 
     return fdxj, fdyj, fdx, fdy
 
-def total_effects_alg(mx, my, edx, edy):
-    """compute algebraic total effects given direct effects and identification matrices"""
+def splu_structural(my):
+    """sparse LU decomposition of (I - my) for sparse direct effects my"""
+
+    return splu(csc_matrix(identity(my.shape[0]) - my))
+
+def dense(mat):
+    """dense numpy array from sparse or dense matrix"""
+
+    return mat.toarray() if issparse(mat) else mat
+
+def total_effects_sparse(mx, my, edx, edy):
+    """compute algebraic total effects given sparse direct effects,
+    returns sparse total effects
+
+    for acyclic models my is nilpotent, so (I - my)^-1 = I + my + my^2 + ...
+    is summed by sparse products until the powers of my vanish,
+    otherwise solved by sparse LU decomposition of (I - my)"""
+
+    ndim = my.shape[0]
+    my = csc_matrix(my)
+    ey = identity(ndim, format="csc")
+    power = my
+    for _ in range(ndim):
+        power.eliminate_zeros()
+        if power.nnz == 0:
+            break
+        ey = ey + power
+        power = power @ my
+    else:
+        ey = csc_matrix(spsolve(csc_matrix(identity(ndim) - my),
+                                identity(ndim, format="csc")))
+    ex = csc_matrix(ey @ mx)
+
+    # set fixed null and unity effects numerically exactly to 0 and 1
+    if edx is not None:
+        ex = csc_matrix(ex.multiply(edx != 0))
+    if edy is not None:
+        ey = csc_matrix(ey.multiply(edy != 0))
+        ey.setdiag(1)
+    ex.eliminate_zeros()
+    ey.eliminate_zeros()
+
+    return ex, ey
+
+def total_effects(mx, my, edx, edy, sparse=False, triangular=False):
+    """compute dense total effects given dense direct effects,
+    by sparse LU decomposition if sparse"""
+
+    if sparse:
+        ex, ey = total_effects_alg(csc_matrix(mx), csc_matrix(my), edx, edy)
+        return ex.toarray(), ey.toarray()
+
+    return total_effects_alg(mx, my, edx, edy, triangular)
+
+def total_effects_alg(mx, my, edx, edy, triangular=False):
+    """compute algebraic total effects given direct effects and identification matrices,
+    mx and my may be stacked over leading observation axes, e.g. (tau, ndim, mdim),
+    or may be sparse matrices, giving sparse total effects,
+    if triangular, my is strictly lower triangular and forward substitution is used"""
 
     # dimensions
-    ndim = mx.shape[0]
+    ndim = mx.shape[-2]
 
     # error if my is not normalized
-    if sum(abs(diag(my))) > 0:
+    if issparse(my):
+        if np.sum(abs(my.diagonal())) > 0:
+            raise ValueError("No Normalization. Diagonal elements of 'my' differ from zero.")
+        return total_effects_sparse(mx, my, edx, edy)
+    if np.sum(abs(np.diagonal(my, axis1=-2, axis2=-1))) > 0:
         raise ValueError("No Normalization. Diagonal elements of 'my' differ from zero.")
 
-    # total effects
-    ey = inv(eye(ndim) - my)
+    # total effects, batched inverse for stacked direct effects
+    if triangular:
+        ey = solve_triangular_structural(my, eye(ndim))
+    else:
+        ey = inv(eye(ndim) - my)
     ex = ey @ mx
 
     # set fixed null and unity effects numerically exactly to 0 and 1
     if edx is not None:
-        ex[edx == 0] = 0
+        ex[..., edx == 0] = 0
     if edy is not None:
-        ey[edy == 0] = 0
-        fill_diagonal(ey, 1)
+        ey[..., edy == 0] = 0
+        ey[..., range(ndim), range(ndim)] = 1
 
     return ex, ey
 
-def sse_orig(mx, my, fym, ychat, ymcdat, selwei, model_dat):
-    """weighted MSE target function plus Tikhonov regularization term"""
+def is_triangular(idy):
+    """check whether endogenous variables are in topological order,
+    i.e. identification matrix idy is strictly lower triangular"""
+
+    return not np.any(np.triu(idy))
+
+def solve_triangular_structural(my, rhs, trans=False):
+    """solve (I - my) @ sol = rhs, or (I - my).T @ sol = rhs if trans,
+    by forward (backward) substitution for strictly lower triangular my in O(ndim**2)
+    per column of rhs, my and rhs may be stacked over leading observation axes"""
+
+    ndim = my.shape[-1]
+    if my.ndim == 2:
+        return solve_triangular(eye(ndim) - my, rhs, trans="T" if trans else "N",
+                                lower=True, unit_diagonal=True)
+
+    # stacked observations, batched substitution in torch
+    if trans:
+        raise ValueError("Transposed solve only for unstacked 'my'.")
+    rhs = np.broadcast_to(rhs, my.shape[:-2] + np.shape(rhs)[-2:])
+    sol = solve_triangular_torch(torch.from_numpy(eye(ndim) - my),
+                                 torch.from_numpy(np.array(rhs, dtype=float)))
+
+    return sol.numpy()
+
+def solve_triangular_torch(a, b):
+    """solve a @ sol = b for lower unit triangular torch tensor a, batched over leading axes,
+    using torch.linalg if available, differentiable"""
+
+    if hasattr(torch, "linalg") and hasattr(torch.linalg, "solve_triangular"):
+        return torch.linalg.solve_triangular(a, b, upper=False, unitriangular=True)
+
+    return torch.triangular_solve(b, a, upper=False, unitriangular=True)[0]
+
+def compute_moments(xcdat, ymcdat):
+    """compute sufficient statistics of demeaned data for the sse of the linear reduced form,
+    computed once per dataset or data split, moments of disjoint splits add up"""
+
+    moments = {
+        "tau": xcdat.shape[1],
+        "xx": xcdat @ xcdat.T,                                  # (mdim x mdim)
+        "yx": ymcdat @ xcdat.T,                                 # (pdim x mdim)
+        "yy": ymcdat @ ymcdat.T,                                # (pdim x pdim)
+        "xsum": xcdat.sum(axis=1),                              # (mdim)
+        "ysum": ymcdat.sum(axis=1),                             # (pdim)
+        }
+
+    return moments
+
+def add_moments(moments, moments_add):
+    """moments of data joined with a disjoint subset of observations,
+    e.g. accumulated over streamed batches"""
+
+    return {key: moments[key] + moments_add[key] for key in moments}
+
+def subtract_moments(moments, moments_sub):
+    """moments of data without a disjoint subset of observations,
+    obtained by subtracting the subset moments from the data moments"""
+
+    return {key: moments[key] - moments_sub[key] for key in moments}
+
+def sse_moments(ex, fym_ind, selwei, moments):
+    """weighted sse of linear reduced form ychat = ex @ xcdat from sufficient statistics,
+    for numpy arrays as well as torch tensors, with manifest rows fym_ind of ex:
+    diag(err @ err.T) = diag(fym @ ex @ xx @ ex.T @ fym.T - 2 * fym @ ex @ yx.T + yy)"""
+
+    a_ = ex[fym_ind]                                            # (pdim x mdim)
+    sse_rows = ((a_ @ moments["xx"]) * a_).sum(1) - 2 * (a_ * moments["yx"]).sum(1) \
+        + moments["yy"].diagonal()
+    sse = (selwei.diagonal() * sse_rows).sum()
+
+    return sse
+
+def sse_orig(mx, my, fym_ind, ex, moments, selwei, model_dat):
+    """weighted MSE target function plus Tikhonov regularization term,
+    computed from data moments, independent of the number of observations"""
 
     # weighted mean squared error
-    ymchat = fym @ ychat
-    err = ymchat - ymcdat
-    
-    #sse = torch.trace(err.T @ selwei @ err) # big matrix needs too much RAM
-    # elementwise multiplication and broadcasting and summation:
-    sse = sum(torch.sum(err * err * torch.diag(selwei).view(-1, 1), dim=0))
+    sse = sse_moments(ex, fym_ind, selwei, moments)
 
     # sse with tikhonov term
-    direct = directvec(mx, my, model_dat["idx"], model_dat["idy"])
+    direct = directvec(mx, my, model_dat["idx"], model_dat["idy"], model_dat["direct_ind"])
     ssetikh = sse + model_dat["alpha"] * direct.T @ direct
 
     return ssetikh.requires_grad_(True)
 
 class StructuralNN(torch.nn.Module):
     """AD identified structural linear nn,
-    linear ychat approximation using ex effects reduced form"""
+    linear ychat = ex @ xcdat approximation using ex effects reduced form"""
 
     def __init__(self, model_dat):
         super(StructuralNN, self).__init__()
@@ -433,7 +729,7 @@ class StructuralNN(torch.nn.Module):
         self.eye = torch.DoubleTensor(eye(model_dat["ndim"]))
         self.idx = torch.DoubleTensor(model_dat["idx"])
         self.idy = torch.DoubleTensor(model_dat["idy"])
-        self.xcdat = torch.DoubleTensor(model_dat["xcdat"])
+        self.triangular = model_dat.get("triangular", False)
 
     def forward(self, mx, my):
 
@@ -442,14 +738,21 @@ class StructuralNN(torch.nn.Module):
         mx = mx * self.idx
         my = my * self.idy
 
-        ey = (self.eye - my).inverse()
-        ex = ey @ mx
-        dy = ex @ self.xcdat    # reduced form
-        ychat = dy
+        # reduced form, by forward substitution if my is strictly lower triangular
+        if self.triangular:
+            ex = solve_triangular_torch(self.eye - my, mx)
+        else:
+            ey = (self.eye - my).inverse()
+            ex = ey @ mx
+
+        return ex
 
-        return ychat
+def moments_torch(moments):
+    """convert data moments to torch tensors"""
 
-def optimize_ssn(ad_model, mx, my, fym, ydata, selwei, model_dat,
+    return {key: torch.DoubleTensor(moments[key]) for key in ("xx", "yx", "yy")}
+
+def optimize_ssn(ad_model, mx, my, fym_ind, moments, selwei, model_dat,
                  optimizer, params, do_print=True):
     """ad torch optimization of structural neural network"""
 
@@ -463,8 +766,8 @@ def optimize_ssn(ad_model, mx, my, fym, ydata, selwei, model_dat,
     epoch = 0
     while nr_conv < nr_conv_min:
         sse_old = copy(sse)
-        ychat = ad_model(*params)
-        sse = sse_orig(mx, my, fym, ychat, ydata, selwei, model_dat)    # forward
+        ex = ad_model(*params)
+        sse = sse_orig(mx, my, fym_ind, ex, moments, selwei, model_dat) # forward
         optimizer.zero_grad()
         sse.backward(create_graph=True)                                 # backward
         optimizer.step()
@@ -479,10 +782,64 @@ def optimize_ssn(ad_model, mx, my, fym, ydata, selwei, model_dat,
 
     return sse
 
-def estimate_snn(model_dat, do_print=True):
+def obs_batches(model_dat, epoch):
+    """demeaned observations xcdat, ymcdat in batches of batch_size columns in model_dat
+    (default 10000), views in random order reproducible per epoch, one pass over the data"""
+
+    tau = model_dat["xcdat"].shape[1]
+    batch_size = model_dat.get("batch_size", 10000)
+    for start in np.random.RandomState(epoch).permutation(range(0, tau, batch_size)):
+        yield (model_dat["xcdat"][:, start:start + batch_size],
+               model_dat["ymcdat"][:, start:start + batch_size])
+
+def optimize_ssn_batch(ad_model, mx, my, fym_ind, selwei, model_dat, params, do_print=True):
+    """ad torch mini-batch optimization of structural neural network,
+    Adam with learning_rate in model_dat (default 0.01) cosine annealed over epochs
+    (default 10), batch sse scaled to tau observations,
+    returns data moments accumulated while streaming the first epoch"""
+
+    epochs = model_dat.get("epochs", 10)
+    if epochs < 1:
+        raise ValueError("epochs must be at least 1 for the minibatch solver.")
+    batches = model_dat.get("batches", obs_batches)
+    optimizer = torch.optim.Adam(params, lr=model_dat.get("learning_rate", 0.01))
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, epochs)
+
+    moments = None
+    for epoch in range(epochs):
+        sses = []
+        for xcdat, ymcdat in batches(model_dat, epoch):
+            moments_batch = compute_moments(xcdat, ymcdat)
+            if epoch == 0:
+                moments = (moments_batch if moments is None
+                           else add_moments(moments, moments_batch))
+            scale = model_dat["tau"] / moments_batch["tau"]
+            moments_scaled = {key: torch.DoubleTensor(scale * moments_batch[key])
+                              for key in ("xx", "yx", "yy")}
+            ex = ad_model(*params)
+            sse = sse_orig(mx, my, fym_ind, ex, moments_scaled, selwei, model_dat) # forward
+            optimizer.zero_grad()
+            sse.backward()                                                      # backward
+            optimizer.step()
+            sses.append(sse.item())
+        if epoch == 0 and (moments is None or moments["tau"] != model_dat["tau"]):
+            raise ValueError("Batches contain {} observations, expected tau = {}."
+                             .format(0 if moments is None else moments["tau"], model_dat["tau"]))
+        scheduler.step()
+        nrm = sum([torch.norm(param) for param in params]).detach().numpy()
+        if do_print:
+            print("epoch {:>4}, mean batch sse {:10f}, param norm {:10f}"
+                  .format(epoch, np.mean(sses), nrm))
+
+    return moments
+
+def estimate_snn(model_dat, do_print=True, start=None):
     """estimate direct effects in identified structural form
     using PyTorch AD automatic differentiation
 
+    starting at given direct effects start = (mx, my),
+    or at theoretical direct effects if start is None
+
     forcasting y is done by reduced form since it is already solved for dy
     structural form:
         dy = my @ dy + mx @ dx
@@ -493,28 +850,44 @@ def estimate_snn(model_dat, do_print=True):
         ex is a linear network with one layer of dimension (ndim, mdim)
         with restrictions edx
     Estimating effects with automatic differentiation only works for DAG
+
+    if solver in model_dat is "minibatch" and observations are available, i.e. xcdat
+    or a streaming source batches(model_dat, epoch) of demeaned (xcdat, ymcdat) batches,
+    mini-batch training followed by a full-batch polish from the streamed moments,
+    otherwise, e.g. for alpha search, full-batch training from data moments
     """
 
-    fym = torch.DoubleTensor(model_dat["fym"])
+    fym_ind = torch.as_tensor(model_dat["fym_ind"])
     selwei = torch.DoubleTensor(model_dat["selwei"])
 
-    # start at theoretical direct effects
-    mx = torch.DoubleTensor(deepcopy(model_dat["mx_theo"]))
-    my = torch.DoubleTensor(deepcopy(model_dat["my_theo"]))
+    # start at given or at theoretical direct effects
+    if start is None:
+        start = (model_dat["mx_theo"], model_dat["my_theo"])
+    mx = torch.DoubleTensor(deepcopy(start[0]))
+    my = torch.DoubleTensor(deepcopy(start[1]))
 
     # define optimization parameters
-    ydata = torch.DoubleTensor(model_dat["ymcdat"]) # ymcdat
     mx.requires_grad_(True)
     my.requires_grad_(True)
     params = [mx, my]
-    ad_model = StructuralNN(model_dat) # ychat
-    # Adam, Adadelta, Adagrad, AdamW, Adamax, RMSprop, Rprop
-    optimizer = torch.optim.Rprop(params)
+    ad_model = StructuralNN(model_dat) # ex
 
     if do_print:
         print("\nEstimation of direct effects using a structural neural network \n"
               "with regularization parameter alpha = {:10f}:".format(model_dat["alpha"]))
-    sse = optimize_ssn(ad_model, mx, my, fym, ydata, selwei, model_dat,
+    if model_dat.get("solver") == "minibatch" and ("batches" in model_dat
+                                                   or "xcdat" in model_dat):
+        moments = optimize_ssn_batch(ad_model, mx, my, fym_ind, selwei, model_dat,
+                                     params, do_print)
+        moments = moments_torch(moments) # streamed data moments
+        if do_print:
+            print("Full-batch polish:")
+    else:
+        moments = moments_torch(model_dat["moments"]) # data moments
+
+    # Adam, Adadelta, Adagrad, AdamW, Adamax, RMSprop, Rprop
+    optimizer = torch.optim.Rprop(params)
+    sse = optimize_ssn(ad_model, mx, my, fym_ind, moments, selwei, model_dat,
                        optimizer, params, do_print)
 
     mx = mx.detach().numpy()
@@ -527,56 +900,75 @@ def estimate_snn(model_dat, do_print=True):
 
     return mx, my, sse
 
-def sse_bias(bias, bias_ind, model_dat):
-    """sum of squared errors given modification indicator, Tikhonov not used"""
+def sse_bias(bias, bias_ind, model_dat, cache, do_print=True):
+    """sum of squared errors given modification indicator, Tikhonov not used,
+    with its exact first and second derivative wrt. the bias,
+    memoized by bias in dict cache"""
+
+    bias = float(np.reshape(bias, -1)[0])
+    if bias not in cache:
+        yhat, dyhat, d2yhat = evaluate_chunked(model_dat["bias_derivs"], model_dat["xdat"],
+                                               model_dat, bias, bias_ind)
+        err = yhat[model_dat["fym_ind"]] - model_dat["ymdat"]
+        dymhat = dyhat[model_dat["fym_ind"]]
+        d2ymhat = d2yhat[model_dat["fym_ind"]]
+        wei = diag(model_dat["selwei"]).reshape(-1, 1)
+        sse = np.sum(err * err * wei)
+        sse_grad = 2 * np.sum(err * dymhat * wei)
+        sse_hess = 2 * np.sum((dymhat * dymhat + err * d2ymhat) * wei)
+        cache[bias] = (sse, sse_grad, sse_hess)
 
-    yhat = model_dat["model"](model_dat["xdat"], bias, bias_ind)
-    ymhat  = model_dat["fym"] @ yhat
-    err = ymhat - model_dat["ymdat"]
-    sse = np.sum(err * err * diag(model_dat["selwei"]).reshape(-1, 1))
-    
-    print("sse {:10f}, bias {:10f}".format(sse, float(bias)))
+        if do_print:
+            print("sse {:10f}, bias {:10f}".format(sse, bias))
 
-    return sse
+    return cache[bias]
 
-def optimize_biases(model_dat, bias_ind):
-    """numerical optimize modification indicator for single equation"""
+def optimize_biases(model_dat, bias_ind, do_print=True):
+    """numerical optimize modification indicator for single equation,
+    using exact gradient and Hessian of sse wrt. the bias"""
 
     # optimizations parameters
     bias_start = 0
-    method = 'SLSQP' # BFGS, SLSQP, Nelder-Mead, Powell, TNC, COBYLA, CG
+    method = 'trust-exact' # requires gradient and Hessian
 
-    print("\nEstimation of bias for {}:".format(model_dat["yvars"][bias_ind]))
-    out = minimize(sse_bias, bias_start, args=(bias_ind, model_dat), method=method)
+    if do_print:
+        print("\nEstimation of bias for {}:".format(model_dat["yvars"][bias_ind]))
+    cache = {} # sse, gradient and Hessian per evaluated bias
+    out = minimize(lambda bias: sse_bias(bias, bias_ind, model_dat, cache, do_print)[:2],
+                   bias_start, method=method, jac=True,
+                   hess=lambda bias: array([[sse_bias(bias, bias_ind, model_dat, cache)[2]]]))
 
     bias = out.x
-    sse = out.fun
-
-    if hasattr(out, 'hess_inv'):
-        hess_i = inv(out.hess_inv)
-        print("Scalar Hessian from method {}.".format(method))
-    else:
-        hess_i = nd.Derivative(sse_bias, n=2)(bias, bias_ind, model_dat)
-        print("Scalar Hessian numerically.")
+    sse, _, hess_i = sse_bias(bias, bias_ind, model_dat, cache)
+    if do_print:
+        print("Scalar Hessian exactly, {} model evaluations.".format(len(cache)))
 
     return bias, hess_i, sse
 
-def sse_hess(mx, my, model_dat):
-    """compute automatic Hessian of sse at given data and direct effects"""
+def sse_hess(mx, my, model_dat, ind=None):
+    """compute automatic Hessian of sse at given data and direct effects,
+    restricted to direct effects with vector indices ind if given"""
 
-    fym = torch.DoubleTensor(model_dat["fym"])
-    ydata = torch.DoubleTensor(model_dat["ymcdat"])
+    fym_ind = torch.as_tensor(model_dat["fym_ind"])
+    moments = moments_torch(model_dat["moments"])
     selwei = torch.DoubleTensor(model_dat["selwei"])
 
     def sse_orig_vec_alg(direct):
         """computes the ad target function sum of squared errors,
         input as tensor vectors, yields Hessian in usual dimension of identified parameters"""
-        mx, my = directmat(direct, model_dat["idx"], model_dat["idy"])
-        ad_model = StructuralNN(model_dat)
-        ychat = ad_model(mx, my)
-        return sse_orig(mx, my, fym, ychat, ydata, selwei, model_dat)
-    direct = directvec(mx, my, model_dat["idx"], model_dat["idy"])
-    hessian = torch.autograd.functional.hessian(sse_orig_vec_alg, direct)
+        mx, my = directmat(direct, model_dat["idx"], model_dat["idy"], model_dat["direct_ind"])
+        ex = ad_model(mx, my)
+        return sse_orig(mx, my, fym_ind, ex, moments, selwei, model_dat)
+    ad_model = StructuralNN(model_dat)
+    direct = directvec(torch.DoubleTensor(mx), torch.DoubleTensor(my),
+                       model_dat["idx"], model_dat["idy"], model_dat["direct_ind"])
+    if ind is None:
+        hessian = torch.autograd.functional.hessian(sse_orig_vec_alg, direct)
+    else:
+        ind = torch.as_tensor(ind)
+        hessian = torch.autograd.functional.hessian(
+            lambda direct_ind: sse_orig_vec_alg(direct.index_put((ind,), direct_ind)),
+            direct[ind])
 
     # symmetrize Hessian, such that numerically well conditioned
     hessian = hessian.detach().numpy()
@@ -588,53 +980,55 @@ def compute_mediation_effects(mx, my, ex, ey, yvars, final_var):
     """compute mediation effects for final variable
 
     use mediation matrix representation with final variable held fixed,
-    in addition, select corresponding total effects vectors on final var"""
+    in addition, select corresponding total effects vectors on final var,
+    effects may be stacked over leading observation axes or may be sparse matrices"""
 
     # dimensions
-    ndim = mx.shape[0]
-    mdim = mx.shape[1]
     jvar = list(yvars).index(final_var)
 
+    # sparse effects matrices give dense vectors and sparse mediation matrices
+    if issparse(my):
+        exj = dense(ex[jvar, :]).reshape(-1)
+        eyj = dense(ey[jvar, :]).reshape(-1)
+        eyx = csc_matrix(mx.multiply(eyj.reshape(-1, 1)))
+        eyy = csc_matrix(my.multiply(eyj.reshape(-1, 1)))
+        return exj, eyj, eyx, eyy
+
     # corresponding total effects vectors on final var
-    exj = ex[jvar, :]                                           # (mdim)
-    eyj = ey[jvar, :]                                           # (ndim)
+    exj = ex[..., jvar, :]                                      # (mdim)
+    eyj = ey[..., jvar, :]                                      # (ndim)
 
     # mediation effects matrices with final var held fixed
-    eyx = (eyj.reshape(ndim, 1) @ ones((1, mdim))) * mx         # (ndim x mdim)
-    eyy = (eyj.reshape(ndim, 1) @ ones((1, ndim))) * my         # (ndim x ndim)
+    eyx = eyj[..., :, None] * mx                                # (ndim x mdim)
+    eyy = eyj[..., :, None] * my                                # (ndim x ndim)
 
     return exj, eyj, eyx, eyy
 
 def tvals(eff, std):
-    """compute t-values by element wise division of eff and std matrices"""
+    """compute t-values by element wise division of eff and std matrices,
+    nan where std is zero"""
     
     assert eff.shape == std.shape
     
-    if len(eff.shape) == 1: # vector
-        rows = eff.shape[0]
-        tvalues = empty(rows) * nan
-        for i in range(rows):
-                if std[i] != 0:
-                    tvalues[i] = eff[i] / std[i]
-    
-    if len(eff.shape) == 2: # matrix
-        rows, cols = eff.shape
-        tvalues = zeros((rows, cols))
-        for i in range(rows):
-            for j in range(cols):
-                if std[i, j] != 0:
-                    tvalues[i, j] = eff[i, j] / std[i, j]
-                else:
-                    tvalues[i, j] = nan
+    tvalues = np.divide(eff, std, out=np.full(eff.shape, nan), where=std != 0)
     
     return tvalues
 
+def colnorm(mat):
+    """mediation matrix normed by division by its column sums,
+    zero sum for varaibles w/o effect on others
+    substituted by nan to avoid false interpretation"""
+
+    colsum = np.sum(mat, axis=0)
+    colsum[colsum==0] = nan
+
+    return mat / colsum
+
 def compute_mediation_std(ex_hat_std, ey_hat_std, eyx, eyy, yvars, final_var):
     """compute mediation std"""
 
     # dimensions
     ndim = ex_hat_std.shape[0]
-    mdim = ex_hat_std.shape[1]
     jvar = list(yvars).index(final_var)
 
     exj_hat_std = ex_hat_std[jvar, :]                           # (mdim)
@@ -644,24 +1038,9 @@ def compute_mediation_std(ex_hat_std, ey_hat_std, eyx, eyy, yvars, final_var):
     exj_hat_std_mat = tile(exj_hat_std, (ndim, 1))              # (ndim x mdim)
     eyj_hat_std_mat = tile(eyj_hat_std, (ndim, 1))              # (ndim x ndim)
 
-    # column sums of mediation matrices
-    x_colsum = np.sum(eyx, axis=0)
-    y_colsum = np.sum(eyy, axis=0)
-    # normed mediation matrices by division by column sums,
-    # zero sum for varaibles w/o effect on others
-    # substituted by nan to avoid false interpretation
-    x_colsum[x_colsum==0] = nan
-    y_colsum[y_colsum==0] = nan
-    eyx_colnorm = zeros((ndim, mdim))                           # (ndim x mdim)
-    eyx_colnorm[:] = nan
-    for j in range(mdim):
-        if not isnan(x_colsum[j]):
-            eyx_colnorm[:, j] = eyx[:, j] / x_colsum[j]
-    eyy_colnorm = zeros((ndim, ndim))                           # (ndim x ndim)
-    eyy_colnorm[:] = nan
-    for j in range(ndim):
-        if not isnan(y_colsum[j]):
-            eyy_colnorm[:, j] = eyy[:, j] / y_colsum[j]
+    # normed mediation matrices by division by column sums
+    eyx_colnorm = colnorm(eyx)                                  # (ndim x mdim)
+    eyy_colnorm = colnorm(eyy)                                  # (ndim x ndim)
 
     # mediation std matrices
     eyx_hat_std = exj_hat_std_mat * eyx_colnorm                 # (ndim x mdim)
@@ -669,81 +1048,91 @@ def compute_mediation_std(ex_hat_std, ey_hat_std, eyx, eyy, yvars, final_var):
 
     return exj_hat_std, eyj_hat_std, eyx_hat_std, eyy_hat_std
 
-def directmat_alg(direct, idx, idy):
+def direct_indices(idx, idy):
+    """row and column indices of identified direct effects, iterating column wise,
+    corresponding to vec of direct effects, (iy, jy, ix, jx)"""
+
+    jy, iy = np.nonzero(idy.T)
+    jx, ix = np.nonzero(idx.T)
+
+    return iy, jy, ix, jx
+
+def directmat_alg(direct, idx, idy, sparse=False, direct_ind=None):
     """algebraic direct effect matrices column-wise
-    from direct effects vector and id matrices"""
+    from direct effects vector and id matrices,
+    as sparse matrices if sparse, scattered at precomputed direct_ind if given"""
 
     # dimensions
     ndim = idx.shape[0]
     mdim = idx.shape[1]
-    qydim = count_nonzero(idy)
+    if direct_ind is None:
+        direct_ind = direct_indices(idx, idy)
+    iy, jy, ix, jx = direct_ind
+    qydim = len(iy)
+
+    # compute sparse direct effects matrices from row and column indices
+    if sparse:
+        my = csc_matrix((direct[0:qydim], (iy, jy)), shape=(ndim, ndim))
+        mx = csc_matrix((direct[qydim:], (ix, jx)), shape=(ndim, mdim))
+        return mx, my
 
     # compute direct effects matrices
     my = zeros((ndim, ndim))
-    my.T[idy.T == 1] = direct[0:qydim]
+    my[iy, jy] = direct[0:qydim]
     mx = zeros((ndim, mdim))
-    mx.T[idx.T == 1] = direct[qydim:]
+    mx[ix, jx] = direct[qydim:]
 
     return mx, my
 
-def directmat(direct, idx, idy):
+def directmat(direct, idx, idy, direct_ind=None):
     """automatic direct effects matrices column-wise
-    from direct effects vector and id matrices"""
+    from direct effects vector and id matrices,
+    scattered at precomputed direct_ind if given"""
 
     # dimensions
     ndim = idx.shape[0]
     mdim = idx.shape[1]
+    if direct_ind is None:
+        direct_ind = direct_indices(idx, idy)
+    iy, jy, ix, jx = (torch.as_tensor(ind) for ind in direct_ind)
+    qydim = len(iy)
 
-    # compute direct effects matrices
-    my = torch.DoubleTensor(zeros((ndim, ndim)))
-    mx = torch.DoubleTensor(zeros((ndim, mdim)))
-    k = 0
-    for i in range(ndim):
-        for j in range(ndim):
-            if idy[i, j] == 1:
-                my[i, j] = direct[k]
-                k += 1
-    for i in range(ndim):
-        for j in range(mdim):
-            if idx[i, j] == 1:
-                mx[i, j] = direct[k]
-                k += 1
+    # compute direct effects matrices, differentiable wrt. direct
+    my = torch.zeros((ndim, ndim), dtype=torch.float64).index_put((iy, jy), direct[0:qydim])
+    mx = torch.zeros((ndim, mdim), dtype=torch.float64).index_put((ix, jx), direct[qydim:])
 
     return mx, my
 
-def directvec_alg(mx, my, idx, idy):
+def directvec_alg(mx, my, idx, idy, direct_ind=None):
     """algebraic direct effects vector column-wise
-     from direct effects matrices and id matrices"""
+    from dense or sparse direct effects matrices and id matrices,
+    gathered at precomputed direct_ind if given"""
+
+    if direct_ind is None:
+        direct_ind = direct_indices(idx, idy)
+    iy, jy, ix, jx = direct_ind
+
+    # gather sparse direct effects at row and column indices
+    if issparse(my):
+        directy = array(my[iy, jy]).reshape(-1)
+        directx = array(mx[ix, jx]).reshape(-1)
+        return concatenate((directy, directx), axis=0)
 
-    directy = my.T[idy.T == 1]
-    directx = mx.T[idx.T == 1]
-    direct = concatenate((directy, directx), axis=0)
+    direct = concatenate((my[iy, jy], mx[ix, jx]), axis=0)
 
     return direct
 
-def directvec(mx, my, idx, idy):
+def directvec(mx, my, idx, idy, direct_ind=None):
     """automatic direct effects vector column-wise
-    from direct effects matrices and id matrices"""
+    from direct effects matrices and id matrices,
+    gathered at precomputed direct_ind if given"""
 
-    # dimensions
-    ndim = idx.shape[0]
-    mdim = idx.shape[1]
-    qydim = count_nonzero(idy)
-    qxdim = count_nonzero(idx)
+    if direct_ind is None:
+        direct_ind = direct_indices(idx, idy)
+    iy, jy, ix, jx = (torch.as_tensor(ind) for ind in direct_ind)
 
-    # compute direct effects vector
-    direct = torch.DoubleTensor(zeros(qydim + qxdim))
-    k = 0
-    for i in range(ndim):
-        for j in range(ndim):
-            if idy[i, j] == 1:
-                direct[k] = my[i, j]
-                k += 1
-    for i in range(ndim):
-        for j in range(mdim):
-            if idx[i, j] == 1:
-                direct[k] = mx[i, j]
-                k += 1
+    # compute direct effects vector, differentiable wrt. mx and my
+    direct = torch.cat((my[iy, jy], mx[ix, jx]))
 
     return direct
 
@@ -761,21 +1150,7 @@ def digital(mat):
     """transform a matrix or vector to digital matrix,
     elements are equal to one if original element is unequal zero, and zero otherwise"""
 
-    if len(mat.shape) == 1:             # vector
-        rows = mat.shape[0]
-        mat_digital = zeros(rows)
-        for i in range(rows):
-            if mat[i] != 0:
-                mat_digital[i] = 1
-
-    if len(mat.shape) == 2:             # matrix
-        rows = mat.shape[0]
-        cols = mat.shape[1]
-        mat_digital = zeros((rows, cols))
-        for i in range(rows):
-            for j in range(cols):
-                if mat[i, j] != 0:
-                    mat_digital[i, j] = 1
+    mat_digital = (mat != 0).astype(float)
 
     return mat_digital
 
@@ -1027,6 +1402,9 @@ def update_model(model_dat):
     model_dat["fx"] = fx
     model_dat["fm"] = fm
     model_dat["fym"] = fym
+    # precomputed indices for gather and scatter instead of loops and selector matrices
+    model_dat["direct_ind"] = direct_indices(model_dat["idx"], model_dat["idy"])
+    model_dat["fym_ind"] = np.nonzero(selvec)[0]
 
     return model_dat
 
@@ -1039,15 +1417,10 @@ def vecmat(mz):
     mdim = mz.shape[1]
     qdim = count_nonzero(mz)
 
+    # k-th column holds k-th nonzero element, iterating column wise, at its vec position
+    cols, rows = np.nonzero(mz.T)
     vec_mat = zeros((ndim * mdim, qdim))
-    k = 0
-    for col in range(mdim):
-        for row in range(ndim):
-            if mz[row, col] != 0:
-                mi = zeros((ndim, mdim))
-                mi[row, col] = mz[row, col]
-                vec_mat[:, k] = reshape(mi, ndim * mdim, order='F')
-                k += 1
+    vec_mat[rows + cols * ndim, np.arange(qdim)] = mz[rows, cols]
 
     return vec_mat
 
@@ -1055,17 +1428,14 @@ def compute_direct_std(vcm_direct_hat, model_dat):
     """compute direct effects standard deviations from direct effects covariance matrix"""
 
     direct_std = diag(vcm_direct_hat)**(1/2)
-    mx_std, my_std = directmat_alg(direct_std, model_dat["idx"], model_dat["idy"])
+    mx_std, my_std = directmat_alg(direct_std, model_dat["idx"], model_dat["idy"],
+                                   direct_ind=model_dat["direct_ind"])
 
     return mx_std, my_std
 
-def total_effects_std(direct_hat, vcm_direct_hat, model_dat):
-    """compute total effects standard deviations
-
-    given estimated vcm_direct_hat,
-    using algebraic delta method for covariance Matrix of effects and
-    algebraic gradient of total effects wrt. direct effects
-    """
+def jac_effects_alg(direct_hat, model_dat, ind=None):
+    """compute algebraic gradient of nonzero total effects wrt. direct effects,
+    restricted to direct effects with vector indices ind if given"""
 
     # compute vec matrices for algebraic effects gradient wrt. to direct_hat
     vecmaty = vecmat(model_dat["idy"])
@@ -1074,8 +1444,12 @@ def total_effects_std(direct_hat, vcm_direct_hat, model_dat):
     vecmatx = hstack((zeros((model_dat["ndim"] * model_dat["mdim"], model_dat["qydim"])), vecmatx))
 
     # compute algebraic gradient of total effects wrt. direct effects
-    mx, my = directmat_alg(direct_hat, model_dat["idx"], model_dat["idy"])
-    ey = inv(eye(model_dat["ndim"]) - my)
+    mx, my = directmat_alg(direct_hat, model_dat["idx"], model_dat["idy"],
+                           direct_ind=model_dat["direct_ind"])
+    if model_dat.get("triangular"):
+        ey = solve_triangular_structural(my, eye(model_dat["ndim"]))
+    else:
+        ey = inv(eye(model_dat["ndim"]) - my)
     jac_effects_y = ((kron(ey.T, ey) - eye(model_dat["ndim"] * model_dat["ndim"]))
                      @ vecmaty + vecmaty)
     jac_effects_x = (kron((ey @ mx).T, ey) @ vecmaty
@@ -1088,20 +1462,131 @@ def total_effects_std(direct_hat, vcm_direct_hat, model_dat):
     jac_effects_y = jac_effects_y[indy, :]
     jac_effects_x = jac_effects_x[indx, :]
     jac_effects = vstack((jac_effects_y, jac_effects_x))
+    if ind is not None:
+        jac_effects = jac_effects[:, ind]
+
+    return jac_effects
+
+def jac_effects_num(direct_hat, model_dat, ind=None):
+    """compute numeric gradient of nonzero total effects wrt. direct effects,
+    restricted to direct effects with vector indices ind if given"""
+
+    if ind is None:
+        ind = np.arange(len(direct_hat))
+
+    def effects_ind(direct_ind):
+        direct = np.array(direct_hat, dtype=float)
+        direct[ind] = direct_ind
+        return total_from_direct(direct, model_dat["idx"], model_dat["idy"],
+                                 model_dat["edx"], model_dat["edy"])
+    jac_effects = nd.Jacobian(effects_ind)(np.array(direct_hat, dtype=float)[ind])
+    jac_effects = jac_effects.reshape(-1, len(ind))
+
+    return jac_effects
+
+def jac_effects_struct(direct_hat, model_dat, ind=None):
+    """compute algebraic gradient of nonzero total effects wrt. direct effects,
+    restricted to direct effects with vector indices ind if given
+
+    using the structure d(ey) = ey @ d(my) @ ey and d(ex) = ey @ d(my) @ ex + ey @ d(mx),
+    the gradient of effect (a, b) wrt. direct effect (i, j) is
+        ey[a, i] * ey[j, b] for ey wrt. my,
+        ey[a, i] * ex[j, b] for ex wrt. my,
+        ey[a, i] * (j == b) for ex wrt. mx,
+    gathered at the indices of nonzero effects and identified direct effects,
+    instead of Kronecker products of dimension (ndim * ndim, ndim * ndim)"""
+
+    if model_dat.get("sparse"):
+        mx, my = directmat_alg(direct_hat, model_dat["idx"], model_dat["idy"], sparse=True,
+                               direct_ind=model_dat["direct_ind"])
+        ey = splu_structural(my).solve(eye(model_dat["ndim"]))
+        ex = ey @ mx.toarray()
+    else:
+        mx, my = directmat_alg(direct_hat, model_dat["idx"], model_dat["idy"],
+                               direct_ind=model_dat["direct_ind"])
+        if model_dat.get("triangular"):
+            ey = solve_triangular_structural(my, eye(model_dat["ndim"]))
+        else:
+            ey = inv(eye(model_dat["ndim"]) - my)
+        ex = ey @ mx
+
+    # row and column indices of nonzero total effects, iterating column wise,
+    # as column vectors corresponding to rows of gradient
+    by, ay = (ind_.reshape(-1, 1) for ind_ in np.nonzero(model_dat["edy"].T))
+    bx, ax = (ind_.reshape(-1, 1) for ind_ in np.nonzero(model_dat["edx"].T))
+    # row and column indices of identified direct effects, iterating column wise,
+    # as row vectors corresponding to columns of gradient
+    iy, jy, ix, jx = model_dat["direct_ind"]
+    if ind is not None:
+        ind = np.asarray(ind)
+        indy = ind[ind < model_dat["qydim"]]
+        indx = ind[ind >= model_dat["qydim"]] - model_dat["qydim"]
+        jy, iy, jx, ix = jy[indy], iy[indy], jx[indx], ix[indx]
+
+    jac_effects = np.block([
+        [ey[ay, iy] * ey[jy, by], zeros((len(ay), len(ix)))],
+        [ey[ax, iy] * ex[jy, bx], ey[ax, ix] * (jx == bx)]])
+
+    return jac_effects
+
+# Jacobian backends: gradient of nonzero total effects wrt. direct effects,
+# given direct effects vector and model_dat
+JACOBIANS = {
+    "alg": jac_effects_alg,         # algebraic, Kronecker products
+    "struct": jac_effects_struct,   # algebraic, gathered
+    "num": jac_effects_num,         # numeric, numdifftools
+    }
+
+def backend(backends, key, default, model_dat):
+    """backend function chosen by key in model_dat from dict of backends"""
+
+    name = model_dat.get(key, default)
+    if name not in backends:
+        raise ValueError("Unknown {} {}, use one of {}.".format(key, name, list(backends)))
+
+    return backends[name]
+
+def compare_backends(backends, key, default, kind, args, model_dat):
+    """cross-check all backends against backend chosen by key in model_dat,
+    on a random sample of direct effects, reporting accuracy and timings
+
+    backend functions are called with args and
+    restricted to the sampled direct effects vector indices ind"""
+
+    nr_sample = 20 # ToDo: define globally
+
+    name_used = model_dat.get(key, default)
+    ind = np.sort(np.random.choice(model_dat["qdim"], min(nr_sample, model_dat["qdim"]),
+                                   replace=False))
+    print("\n{} backends on {} sampled direct effects:".format(kind, len(ind)))
+    results = {}
+    for name in sorted(backends, key=lambda name: name != name_used):
+        start = time.time()
+        results[name] = backends[name](*args, ind=ind)
+        seconds = time.time() - start
+        if name == name_used:
+            print("{:6s} used, {:10f} s".format(name, seconds))
+        else:
+            print("{:6s} allclose: {:5s} with accuracy {:10f}, {:10f} s".format(
+                name, str(allclose(results[name], results[name_used], atol=10**(-4))),
+                acc(results[name], results[name_used]), seconds))
 
-    # compare numeric and algebraic gradient of effects
-    do_compare = True
-    if do_compare:
-        jac_effects_num = nd.Jacobian(total_from_direct)(
-            direct_hat, model_dat["idx"], model_dat["idy"], model_dat["edx"], model_dat["edy"])
-        jac_effects_num = jac_effects_num.reshape(jac_effects.shape)
-        atol = 10**(-4) # instead of default 10**(-8)
-        print("Numeric and algebraic gradient of total effects wrt. direct effects allclose: {}."
-              .format(allclose(jac_effects_num, jac_effects, atol=atol)))
-
-    # algebraic delta method effects covariance Matrix
-    vcm_effects = jac_effects @ vcm_direct_hat @ jac_effects.T
-    effects_std = diag(vcm_effects)**(1/2)
+def total_effects_std(direct_hat, vcm_direct_hat, model_dat):
+    """compute total effects standard deviations
+
+    given estimated vcm_direct_hat,
+    using algebraic delta method for variances of effects and
+    gradient of total effects wrt. direct effects,
+    computed by backend chosen by jacobian_backend in model_dat
+    """
+
+    jac_effects = backend(JACOBIANS, "jacobian_backend", "struct", model_dat)(
+        direct_hat, model_dat)
+
+    # algebraic delta method effects variances,
+    # diagonal of effects covariance Matrix jac_effects @ vcm_direct_hat @ jac_effects.T
+    effects_var = np.sum((jac_effects @ vcm_direct_hat) * jac_effects, axis=1)
+    effects_std = effects_var**(1/2)
     ex_std, ey_std = directmat_alg(effects_std, model_dat["edx"], model_dat["edy"])
     # set main diag of ey_std to 0, since edy diag is 1 instead of 0
     np.fill_diagonal(ey_std, 0)
@@ -1133,30 +1618,153 @@ def scale_height(drawing, height_cm):
 
     return scale(drawing, scaling_factor)
 
-def render_dot(dot_str, out_type=None):
-    """render Graphviz graph from dot_str to svg or other formats using pydot"""
-
-    if out_type == "svg":
-        # avoid svg UTF-8 problems for german umlauts
-        dot_str = ''.join([i if ord(i) < 128  else "&#%s;" % ord(i) for i in dot_str])
-        graph = pydot.graph_from_dot_data(dot_str)[0]
-        xml_string = graph.create_svg()
-        graph = svg.fromstring(xml_string)
-    else:
-        graph = pydot.graph_from_dot_data(dot_str)[0]
-
-    return graph
+def graph_cache_file(cache_dir, dot_str, out_type):
+    """cache file of rendered graph, content addressed by hash of dot_str and output format"""
+
+    key = hashlib.sha256((out_type + "\n" + dot_str).encode()).hexdigest()
+
+    return os.path.join(cache_dir, key + "." + out_type)
+
+# running total of bytes per graph cache directory, scanned once per process
+GRAPH_CACHE_SIZES = {}
+GRAPH_CACHE_LOCK = threading.Lock()
+
+def scan_graph_cache(cache_dir):
+    """cache entries (modification time, size, path) of graph cache directory"""
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and not entry.name.endswith(".tmp"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:       # evicted concurrently
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    return entries
+
+def store_graph_cache(cache_file, content, cache_size):
+    """store rendered graph atomically in cache, keeping a running total of the cache size,
+    only if it exceeds cache_size, the cache is scanned and least recently used files
+    are evicted down to 90% of cache_size, such that scans are rare"""
+
+    cache_dir = os.path.dirname(cache_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    with GRAPH_CACHE_LOCK:
+        if cache_dir not in GRAPH_CACHE_SIZES:
+            GRAPH_CACHE_SIZES[cache_dir] = sum(size for _, size, _ in scan_graph_cache(cache_dir))
+    try:
+        size_old = os.path.getsize(cache_file)
+    except FileNotFoundError:
+        size_old = 0
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False) as file:
+        file.write(content)
+    os.replace(file.name, cache_file)
+
+    with GRAPH_CACHE_LOCK:
+        GRAPH_CACHE_SIZES[cache_dir] += len(content) - size_old
+        if GRAPH_CACHE_SIZES[cache_dir] <= cache_size:
+            return
+
+        # least recently used by modification time, refreshed on each cache hit
+        entries = scan_graph_cache(cache_dir)
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= 0.9 * cache_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        GRAPH_CACHE_SIZES[cache_dir] = total
+
+# Graphviz dot output statements: node or edge, and their position attributes,
+# ids are quoted strings, numerals, e.g. unquoted negative labels, or other names
+DOT_ID = r'"(?:[^"\\]|\\.)*"|-?(?:\.\d+|\d+(?:\.\d*)?)|[^\s\[\];,"=-]+'
+DOT_STATEMENT = re.compile(r'^\s*({0})(?:\s*->\s*({0}))?\s*\[((?:\s*\w+\s*=\s*(?:{0}),?)*)\s*\];?'
+                           .format(DOT_ID), re.MULTILINE)
+DOT_POSITION = re.compile(r'\b(pos|lp)\s*=\s*"([^"]*)"')
+
+def graph_layout(dot_str, cache_dir=None, cache_size=100e6):
+    """compute Graphviz layout of dot_str once, for graphs of same topology,
+    returns dot attribute strings of node positions by node name
+    and of edge splines and label positions by (tail, head),
+    the positioned dot output is taken from and stored in cache_dir if given"""
+
+    layout_str = None
+    if cache_dir is not None:
+        layout_cache = graph_cache_file(cache_dir, dot_str, "dot")
+        try:
+            with open(layout_cache, "rb") as file:
+                layout_str = file.read()
+            os.utime(layout_cache)
+        except FileNotFoundError:
+            pass
+    if layout_str is None:
+        process = subprocess.run(["dot", "-Tdot"], input=dot_str.encode(),
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise RuntimeError("Graphviz failed computing layout:\n{}"
+                               .format(process.stderr.decode(errors="replace")))
+        layout_str = process.stdout
+        if cache_dir is not None:
+            store_graph_cache(layout_cache, layout_str, cache_size)
+
+    # node and edge statements of positioned dot output, long lines are continued by
+    # backslash newline, attribute lists may span several lines
+    layout_str = layout_str.decode().replace("\\\n", "")
+    layout = {}
+    for match in DOT_STATEMENT.finditer(layout_str):
+        tail, head, attrs = match.groups()
+        positions = "".join([', {} = "{}"'.format(key, value)
+                             for key, value in DOT_POSITION.findall(attrs)])
+        if head is None:
+            layout[tail.strip('"')] = positions
+        else:
+            layout[(tail.strip('"'), head.strip('"'))] = positions
 
-def save_graph(path, filename, graph_dot):
-    """save graph to file as dot string and png"""
+    return layout
 
-    #with open(path + filename + ".txt", "w") as file:
-    #    file.write(graph_dot)
+def render_graph(dot_str, path, filename, cache_dir=None, cache_size=100e6, prog=("dot",)):
+    """render Graphviz graph from dot_str with a single layout pass,
+    save it as png and return it as svg string,
+    png and svg are taken from and stored in an on-disk cache in cache_dir if given,
+    prog ("neato", "-n2") renders dot_str with given positions without layout pass"""
 
-    graph = render_dot(graph_dot)
-    graph.write_png(path + filename + ".png")
+    # avoid svg UTF-8 problems for german umlauts, entities are also rendered in png
+    dot_str = ''.join([i if ord(i) < 128  else "&#%s;" % ord(i) for i in dot_str])
+    png_path = path + filename + ".png"
 
-    return
+    # cache hit, refresh modification time for least recently used eviction
+    if cache_dir is not None:
+        png_cache = graph_cache_file(cache_dir, dot_str, "png")
+        svg_cache = graph_cache_file(cache_dir, dot_str, "svg")
+        try:
+            shutil.copyfile(png_cache, png_path)
+            with open(svg_cache, "rb") as file:
+                svg_str = file.read()
+            os.utime(png_cache)
+            os.utime(svg_cache)
+            return svg_str
+        except FileNotFoundError:
+            pass
+
+    # one Graphviz subprocess for all formats, png to file and svg to stdout
+    process = subprocess.run(list(prog) + ["-Tpng", "-o" + png_path, "-Tsvg"],
+                             input=dot_str.encode(), stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise RuntimeError("Graphviz failed rendering {}:\n{}"
+                           .format(filename, process.stderr.decode(errors="replace")))
+    svg_str = process.stdout
+
+    if cache_dir is not None:
+        with open(png_path, "rb") as file:
+            store_graph_cache(png_cache, file.read(), cache_size)
+        store_graph_cache(svg_cache, svg_str, cache_size)
+
+    return svg_str
 
 def acc(n1, n2):
     """accuracy: similarity of two numeric matrices,